@@ -1,4 +1,7 @@
-from typing import List
+from itertools import product
+from typing import Callable, List, Tuple
+
+import numpy as np
 
 
 class BaseConfig:
@@ -8,13 +11,23 @@ class BaseConfig:
                  type_vol: float = None,
                  depth: int = None,
                  coordinates_basis: str = None,
-                 stop_loss: float = None):
+                 stop_loss: float = None,
+                 use_cache: bool = True,
+                 cache_dir: str = None,
+                 read_chunk_rows: int = None,
+                 shared_bars=None):
         self.file_path = file_path
         self.sma_window = sma_window
         self.type_vol = type_vol
         self.depth = depth
         self.coordinates_basis = coordinates_basis
         self.stop_loss = stop_loss
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+        # Bars are streamed in chunks of about this many rows instead of loaded at once
+        self.read_chunk_rows = read_chunk_rows
+        # SharedBars handle: bars are attached from shared memory instead of read from file_path
+        self.shared_bars = shared_bars
 
     @staticmethod
     def builder():
@@ -28,6 +41,10 @@ class BaseConfig:
             self._depth = None
             self._coordinates_basis = None
             self._stop_loss = None
+            self._use_cache = True
+            self._cache_dir = None
+            self._read_chunk_rows = None
+            self._shared_bars = None
 
         def with_file_path(self, file_path: str):
             self._file_path = file_path
@@ -53,6 +70,22 @@ class BaseConfig:
             self._stop_loss = stop_loss
             return self
 
+        def with_use_cache(self, use_cache: bool):
+            self._use_cache = use_cache
+            return self
+
+        def with_cache_dir(self, cache_dir: str):
+            self._cache_dir = cache_dir
+            return self
+
+        def with_read_chunk_rows(self, read_chunk_rows: int):
+            self._read_chunk_rows = read_chunk_rows
+            return self
+
+        def with_shared_bars(self, shared_bars):
+            self._shared_bars = shared_bars
+            return self
+
         def build(self):
             return BaseConfig(
                 file_path=self._file_path,
@@ -60,11 +93,109 @@ class BaseConfig:
                 type_vol=self._type_vol,
                 depth=self._depth,
                 coordinates_basis=self._coordinates_basis,
-                stop_loss=self._stop_loss
+                stop_loss=self._stop_loss,
+                use_cache=self._use_cache,
+                cache_dir=self._cache_dir,
+                read_chunk_rows=self._read_chunk_rows,
+                shared_bars=self._shared_bars
+            )
+
+
+class SweepConfig:
+    """
+        Value ranges of the job parameters for one source file.
+        configs() yields a BaseConfig for every combination.
+    """
+
+    def __init__(self,
+                 file_path: str = None,
+                 sma_windows: List[int] = None,
+                 type_vols: List[float] = None,
+                 depths: List[int] = None,
+                 coordinates_bases: List[str] = None,
+                 stop_losses: List[float] = None,
+                 use_cache: bool = True,
+                 cache_dir: str = None):
+        self.file_path = file_path
+        self.sma_windows = sma_windows
+        self.type_vols = type_vols
+        self.depths = depths
+        self.coordinates_bases = coordinates_bases
+        self.stop_losses = stop_losses
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+
+    def configs(self) -> List[BaseConfig]:
+        return [BaseConfig(self.file_path, sma_window, type_vol, depth, coordinates_basis, stop_loss,
+                           self.use_cache, self.cache_dir)
+                for sma_window, type_vol, depth, coordinates_basis, stop_loss in product(self.sma_windows,
+                                                                                        self.type_vols,
+                                                                                        self.depths,
+                                                                                        self.coordinates_bases,
+                                                                                        self.stop_losses)]
+
+    @staticmethod
+    def builder():
+        return SweepConfig.Builder()
+
+    class Builder:
+        def __init__(self):
+            self._file_path = None
+            self._sma_windows = None
+            self._type_vols = None
+            self._depths = None
+            self._coordinates_bases = None
+            self._stop_losses = None
+            self._use_cache = True
+            self._cache_dir = None
+
+        def with_file_path(self, file_path: str):
+            self._file_path = file_path
+            return self
+
+        def with_sma_windows(self, sma_windows: List[int]):
+            self._sma_windows = sma_windows
+            return self
+
+        def with_type_vols(self, type_vols: List[float]):
+            self._type_vols = type_vols
+            return self
+
+        def with_depths(self, depths: List[int]):
+            self._depths = depths
+            return self
+
+        def with_coordinates_bases(self, coordinates_bases: List[str]):
+            self._coordinates_bases = coordinates_bases
+            return self
+
+        def with_stop_losses(self, stop_losses: List[float]):
+            self._stop_losses = stop_losses
+            return self
+
+        def with_use_cache(self, use_cache: bool):
+            self._use_cache = use_cache
+            return self
+
+        def with_cache_dir(self, cache_dir: str):
+            self._cache_dir = cache_dir
+            return self
+
+        def build(self):
+            return SweepConfig(
+                file_path=self._file_path,
+                sma_windows=self._sma_windows,
+                type_vols=self._type_vols,
+                depths=self._depths,
+                coordinates_bases=self._coordinates_bases,
+                stop_losses=self._stop_losses,
+                use_cache=self._use_cache,
+                cache_dir=self._cache_dir
             )
 
 
 class Bar:
+    __slots__ = ('date_time', 'price_open', 'price_high', 'price_low', 'price_close', 'volume', 'ts')
 
     def __init__(self,
                  date_time,
@@ -93,13 +224,126 @@ class Bar:
                 f"Timestamp={self.ts}")
 
 
+class BarStore:
+    """
+        Columnar bar storage: one contiguous NumPy array per field.
+
+        Bars are kept grouped by day (a stable sort is applied if the input is not),
+        so every trading day is a zero-copy slice [offsets[k], offsets[k + 1]).
+        Bar objects are only created on demand by bar() / bars().
+    """
+
+    def __init__(self,
+                 date_time,
+                 price_open,
+                 price_high,
+                 price_low,
+                 price_close,
+                 volume,
+                 ts):
+        self.date_time = np.asarray(date_time, dtype='datetime64[ns]')
+        self.price_open = np.asarray(price_open, dtype=np.float64)
+        self.price_high = np.asarray(price_high, dtype=np.float64)
+        self.price_low = np.asarray(price_low, dtype=np.float64)
+        self.price_close = np.asarray(price_close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.int64)
+        self.ts = np.asarray(ts, dtype=np.float64)
+        self._days = None
+
+        day_keys = self.date_time.astype('datetime64[D]')
+        if len(day_keys) > 1 and (day_keys[1:] < day_keys[:-1]).any():
+            order = np.argsort(day_keys, kind='stable')
+            for name in self.columns():
+                setattr(self, name, getattr(self, name)[order])
+
+    @staticmethod
+    def columns() -> Tuple[str, ...]:
+        return 'date_time', 'price_open', 'price_high', 'price_low', 'price_close', 'volume', 'ts'
+
+    @staticmethod
+    def from_bars(bars: List[Bar]) -> 'BarStore':
+        return BarStore([bar.date_time for bar in bars],
+                        [bar.price_open for bar in bars],
+                        [bar.price_high for bar in bars],
+                        [bar.price_low for bar in bars],
+                        [bar.price_close for bar in bars],
+                        [bar.volume for bar in bars],
+                        [bar.ts for bar in bars])
+
+    @staticmethod
+    def concat(stores: List['BarStore']) -> 'BarStore':
+        return BarStore(*[np.concatenate([getattr(store, name) for store in stores]) for name in BarStore.columns()])
+
+    def __len__(self):
+        return len(self.date_time)
+
+    def bar(self, i: int) -> Bar:
+        return Bar(self.date_time[i].astype('datetime64[us]').item(),
+                   self.price_open[i].item(),
+                   self.price_high[i].item(),
+                   self.price_low[i].item(),
+                   self.price_close[i].item(),
+                   self.volume[i].item(),
+                   self.ts[i].item())
+
+    def bars(self) -> List[Bar]:
+        return [Bar(*fields) for fields in zip(self.date_time.astype('datetime64[us]').tolist(),
+                                               self.price_open.tolist(),
+                                               self.price_high.tolist(),
+                                               self.price_low.tolist(),
+                                               self.price_close.tolist(),
+                                               self.volume.tolist(),
+                                               self.ts.tolist())]
+
+    def slice(self, start: int, end: int) -> 'BarStore':
+        store = BarStore.__new__(BarStore)
+        for name in self.columns():
+            setattr(store, name, getattr(self, name)[start:end])
+        store._days = None
+        return store
+
+    def days(self) -> Tuple[List[str], np.ndarray]:
+        """
+            Day index of the store.
+
+            Example -> (['2022-03-30', '2022-03-31'], array([0, 79, 158]))
+        """
+        if self._days is None:
+            day_keys = self.date_time.astype('datetime64[D]')
+            starts = np.flatnonzero(np.concatenate(([True], day_keys[1:] != day_keys[:-1]))) \
+                if len(day_keys) else np.empty(0, dtype=np.int64)
+            offsets = np.append(starts, len(day_keys))
+            self._days = (day_keys[starts].astype(str).tolist(), offsets)
+        return self._days
+
+
 class TradingDay:
 
-    def __init__(self, bars: List[Bar], stock_name):
-        self.bars = bars
-        self.date = bars[0].date_time.date()
+    def __init__(self, bars: List[Bar], stock_name, store: BarStore = None):
+        self._bars = bars
+        self._store = store
+        self.date = (bars[0] if bars is not None else store.bar(0)).date_time.date()
         self.stock_name = stock_name
 
+    @staticmethod
+    def from_store(store: BarStore, stock_name) -> 'TradingDay':
+        return TradingDay(None, stock_name, store)
+
+    @property
+    def bars(self) -> List[Bar]:
+        if self._bars is None:
+            self._bars = self._store.bars()
+        return self._bars
+
+    @property
+    def store(self) -> BarStore:
+        if self._store is None:
+            self._store = BarStore.from_bars(self._bars)
+        return self._store
+
+    def __len__(self):
+        return len(self._bars) if self._bars is not None else len(self._store)
+
     def __str__(self):
         return "\n".join([f"Trading day={self.date}, "
                           f"Open={bar.price_open}, "
@@ -113,7 +357,7 @@ class BacktestObject:
 
     def __init__(self,
                  date: str,
-                 grid: str,
+                 grid: np.ndarray,
                  trade_test_result: dict):
         self.date = date
         self.grid = grid
@@ -146,3 +390,31 @@ class TestResults:
                 f"opened_time={self.opened_time}, "
                 f"close_price={self.closed_price}, "
                 f"close_time={self.closed_time})")
+
+
+class JobResult:
+    """
+        Outcome of a job run in a worker process: its rows as a compact NumPy record
+        array (to be written by the parent) or the error that stopped it,
+        and the worker's stage metrics records when they are enabled.
+        `on_written` (picklable) is called by the writer once the rows were written, e.g. to commit job state.
+    """
+
+    def __init__(self, stock_name: str, table_name: str, records: np.recarray = None, error: str = None,
+                 metrics: List[dict] = None, on_written: Callable[[], None] = None):
+        self.stock_name = stock_name
+        self.table_name = table_name
+        self.records = records
+        self.error = error
+        self.metrics = metrics
+        self.on_written = on_written
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __str__(self):
+        return (f"JobResult(stock_name={self.stock_name}, "
+                f"table_name={self.table_name}, "
+                f"rows={0 if self.records is None else len(self.records)}, "
+                f"error={self.error})")
@@ -1,25 +1,114 @@
+import numpy as np
 import pandas as pd
 
-from ent.base_ds import Bar
-from typing import List
-from utils import to_datetime, to_float, to_int
+from datetime import time
+from ent.base_ds import Bar, BarStore
+from typing import Iterator, List
+from utils import log, to_datetime, to_float, to_int
 
 
 class BarMapper:
 
     @staticmethod
     def list_to_bar(row: list) -> Bar:
-        bar = Bar(to_datetime(row[0]),
+        date_time = to_datetime(row[0])
+        bar = Bar(date_time,
                   to_float(row[3]),
                   to_float(row[4]),
                   to_float(row[5]),
                   to_float(row[6]),
                   to_int(row[7]),
-                  to_datetime(row[0]).timestamp())
+                  date_time.timestamp())
 
         if bar.price_low is not None:
             return bar
 
+    @staticmethod
+    def _local_timestamps(date_time: np.ndarray) -> np.ndarray:
+        # Same values as datetime.timestamp() of naive local times. The UTC offset is taken
+        # once per day at noon, which is exact for session hours (DST switches at night).
+        days, inverse = np.unique(date_time.astype('datetime64[D]'), return_inverse=True)
+        noon = (days + np.timedelta64(12, 'h')).astype('datetime64[s]')
+        naive_noon = (noon - np.datetime64(0, 's')) / np.timedelta64(1, 's')
+        offsets = np.array([dt.timestamp() for dt in noon.tolist()]) - naive_noon
+        naive = (date_time - np.datetime64(0, 'ns')) / np.timedelta64(1, 's')
+        return naive + offsets[inverse]
+
+    @staticmethod
+    def _read_csv(source, chunk_rows: int = None):
+        return pd.read_csv(source,
+                           header=None,
+                           skiprows=1,
+                           usecols=[0, 3, 4, 5, 6, 7],
+                           dtype={0: str, 3: np.float64, 4: np.float64, 5: np.float64, 6: np.float64, 7: np.float64},
+                           keep_default_na=False,
+                           na_values=[''],
+                           chunksize=chunk_rows)
+
+    @staticmethod
+    def _frame_to_bar_store(df: pd.DataFrame, start_time: time, end_time: time) -> BarStore:
+        date_time = pd.to_datetime(df[0], format='%Y-%m-%d %H:%M:%S').to_numpy(dtype='datetime64[ns]')
+        time_of_day = date_time - date_time.astype('datetime64[D]')
+        start = np.timedelta64(start_time.hour * 3600 + start_time.minute * 60 + start_time.second, 's')
+        end = np.timedelta64(end_time.hour * 3600 + end_time.minute * 60 + end_time.second, 's')
+
+        price_low = df[5].to_numpy()
+        mask = (time_of_day > start) & (time_of_day < end) & ~np.isnan(price_low)
+
+        # An empty volume is 0, as in list_to_bar; a fractional one can't be stored as a count, the bar is dropped
+        volume = np.nan_to_num(df[7].to_numpy(), nan=0)
+        bad_volume = mask & (~np.isfinite(volume) | (volume != np.floor(volume)))
+        if bad_volume.any():
+            log(f"Dropped {int(bad_volume.sum())} bars with a non-integral volume, "
+                f"first at {date_time[bad_volume][0]}")
+            mask &= ~bad_volume
+
+        date_time = date_time[mask]
+        volume = volume[mask]
+        return BarStore(date_time,
+                        df[3].to_numpy()[mask],
+                        df[4].to_numpy()[mask],
+                        price_low[mask],
+                        df[6].to_numpy()[mask],
+                        volume.astype(np.int64),
+                        BarMapper._local_timestamps(date_time))
+
+    @staticmethod
+    def csv_to_bar_store(source, start_time: time, end_time: time) -> BarStore:
+        """
+            Bulk load of a 5 min bars CSV (datetime at column 0, open/high/low/close/volume at 3..7).
+            Keeps bars with start_time < time < end_time and a non-empty low, as list_to_bar does.
+            An empty volume is 0; bars with a non-integral volume are dropped and logged.
+        """
+        return BarMapper._frame_to_bar_store(BarMapper._read_csv(source), start_time, end_time)
+
+    @staticmethod
+    def csv_to_bar_stores(source, start_time: time, end_time: time, chunk_rows: int) -> Iterator[BarStore]:
+        """
+            csv_to_bar_store() in chunks of `chunk_rows` CSV rows, for files sorted by date.
+            Every yielded store holds complete days only: the last day of a chunk is carried over
+            to the next one, so at most one chunk plus one day is in memory.
+        """
+        carry = None
+        for df in BarMapper._read_csv(source, chunk_rows):
+            store = BarMapper._frame_to_bar_store(df, start_time, end_time)
+            if carry is not None:
+                if len(store) and store.date_time[0].astype('datetime64[D]') < carry.date_time[-1].astype('datetime64[D]'):
+                    raise ValueError(f'{source} is not sorted by date and can\'t be streamed')
+                store = BarStore.concat([carry, store])
+            if not len(store):
+                continue
+
+            day_keys = store.date_time.astype('datetime64[D]')
+            last_day_start = int(np.searchsorted(day_keys, day_keys[-1]))
+            # A copy, so the chunk isn't kept alive by the carried day
+            carry = BarStore.concat([store.slice(last_day_start, len(store))])
+            if last_day_start:
+                yield store.slice(0, last_day_start)
+
+        if carry is not None and len(carry):
+            yield carry
+
     @staticmethod
     def bars_list_to_pandas_df(bars: List[Bar]) -> pd.DataFrame:
         data = {
@@ -52,6 +141,18 @@ class BarMapper:
         df.set_index('datetime', inplace=True)
         return df
 
+    @staticmethod
+    def bar_store_to_pandas_df(store: BarStore) -> pd.DataFrame:
+        # Columns are handed to pandas as-is, the frame is a view on the store
+        return pd.DataFrame({
+            'open': store.price_open,
+            'high': store.price_high,
+            'low': store.price_low,
+            'close': store.price_close,
+            'volume': store.volume,
+            'timestamp': store.ts,
+        }, index=pd.DatetimeIndex(store.date_time, name='datetime', copy=False), copy=False)
+
     @staticmethod
     def test_results_to_pandas_df(test_results: dict) -> pd.DataFrame:
         # stock_name, date, Coordinates, Side, Result, Open--, Close--, Close Status, Open Time--, Close Time--
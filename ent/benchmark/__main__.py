@@ -0,0 +1,69 @@
+import argparse
+import json
+import sys
+
+from ent.benchmark.generator import SyntheticDataGenerator
+from ent.benchmark.imports import IMPORT_BUDGETS, check_imports
+from ent.benchmark.suite import BenchmarkSuite, SCENARIOS, compare, load
+from ent.utils import log
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m ent.benchmark', description='Benchmarks over synthetic data')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run scenarios and write results as JSON')
+    run_parser.add_argument('--days', type=int, nargs='+', default=[60, 250, 1000], help='history sizes')
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--scenarios', nargs='*', default=None,
+                            help=f'scenario name prefixes, of: {", ".join(SCENARIOS)}')
+    run_parser.add_argument('--db-url', default=None, help='database of repository scenarios (default: SQLite)')
+    run_parser.add_argument('--work-dir', default=None)
+    run_parser.add_argument('--output', default=None, help='results file (default: stdout)')
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=1.1, help='max current / baseline time ratio')
+
+    generate_parser = commands.add_parser('generate', help='write a synthetic CSV')
+    generate_parser.add_argument('directory')
+    generate_parser.add_argument('--days', type=int, default=250)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--stock-name', default='SYNTH')
+
+    imports_parser = commands.add_parser('imports', help='check import time of the batch path modules')
+    imports_parser.add_argument('--modules', nargs='*', default=None, help=f'default: {", ".join(IMPORT_BUDGETS)}')
+    imports_parser.add_argument('--budget', type=float, default=None, help='seconds, overrides the default budgets')
+    imports_parser.add_argument('--repeat', type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.command == 'run':
+        results = BenchmarkSuite(args.days, args.repeat, args.seed, args.scenarios, args.work_dir, args.db_url).run()
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+    elif args.command == 'compare':
+        comparison = compare(load(args.baseline), load(args.current), args.tolerance)
+        for c in comparison:
+            log(f"{c['scenario']:<32} {c['days']:>6} {c['baseline_s']:>10.4f} {c['current_s']:>10.4f} "
+                f"{c['ratio']:>6.2f}{'  REGRESSION' if c['regression'] else ''}")
+        sys.exit(1 if any(c['regression'] for c in comparison) else 0)
+    elif args.command == 'imports':
+        modules = args.modules if args.modules else list(IMPORT_BUDGETS)
+        budgets = {module: args.budget if args.budget else IMPORT_BUDGETS.get(module, 1.0) for module in modules}
+        results = check_imports(budgets, args.repeat)
+        for r in results:
+            log(f"{r['module']:<24} {r['seconds']:>8.3f} s / {r['budget_s']:.3f} s {r['modules']:>6} modules "
+                f"{r['max_rss_bytes'] / 2 ** 20:>8.1f} MiB{'' if r['ok'] else '  OVER BUDGET'}"
+                f"{'  loaded: ' + ', '.join(r['loaded']) if r['loaded'] else ''}")
+        sys.exit(0 if all(r['ok'] for r in results) else 1)
+    else:
+        log(SyntheticDataGenerator(args.seed).write_csv(args.directory, args.days, args.stock_name))
@@ -0,0 +1,64 @@
+import datetime
+import os
+
+import numpy as np
+
+
+class SyntheticDataGenerator:
+    """
+        Seeded random-walk OHLCV data in the source_data CSV layout: datetime at column 0,
+        open/high/low/close/volume at columns 3..7, 79 bars of 5 min from 09:30 to 16:00 per weekday.
+        The same seed and arguments always give the same file.
+    """
+
+    bars_per_day = 79
+    session_start = datetime.time(9, 30)
+    header = 'datetime,symbol,timeframe,open,high,low,close,volume\n'
+
+    def __init__(self, seed: int = 0, start_price: float = 100.0, volatility: float = 0.002):
+        self.seed = seed
+        self.start_price = start_price
+        self.volatility = volatility
+
+    def trading_dates(self, days: int, start_date: datetime.date = datetime.date(2020, 1, 1)) -> np.ndarray:
+        dates = np.arange(np.datetime64(start_date, 'D'), np.datetime64(start_date, 'D') + days * 2 + 7)
+        return dates[np.is_busday(dates)][:days]
+
+    def generate(self, days: int, stock_name: str = 'SYNTH') -> dict:
+        """
+            Columns of `days` trading days.
+            Example -> {'datetime': array(['2020-01-01T09:30', ...]), 'open': array([100.0, ...]), ...}
+        """
+        rng = np.random.default_rng(self.seed)
+        n = days * self.bars_per_day
+
+        times = np.datetime64('1970-01-01T09:30', 'm') - np.datetime64('1970-01-01', 'D') + \
+            np.arange(self.bars_per_day) * np.timedelta64(5, 'm')
+        date_time = (self.trading_dates(days).astype('datetime64[m]')[:, None] + times).ravel()
+
+        returns = rng.normal(0, self.volatility, n)
+        close = self.start_price * np.exp(np.cumsum(returns))
+        open_ = np.concatenate(([self.start_price], close[:-1]))
+        wick = np.abs(rng.normal(0, self.volatility / 2, (2, n))) * close
+        high = np.maximum(open_, close) + wick[0]
+        low = np.minimum(open_, close) - wick[1]
+        volume = rng.integers(100, 10_000, n)
+
+        return {'datetime': date_time, 'symbol': stock_name,
+                'open': open_, 'high': high, 'low': low, 'close': close, 'volume': volume}
+
+    def write_csv(self, directory: str, days: int, stock_name: str = 'SYNTH') -> str:
+        """
+            Writes <directory>/<stock_name>_5min.csv and returns its path.
+        """
+        columns = self.generate(days, stock_name)
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, f'{stock_name}_5min.csv')
+
+        date_time = np.datetime_as_string(columns['datetime'], unit='s')
+        prices = [np.char.mod('%.4f', columns[name]) for name in ('open', 'high', 'low', 'close')]
+        with open(file_path, 'w') as f:
+            f.write(self.header)
+            f.writelines(f'{dt.replace("T", " ")},{stock_name},5,{o},{h},{lo},{c},{v}\n'
+                         for dt, o, h, lo, c, v in zip(date_time, *prices, columns['volume'].tolist()))
+        return file_path
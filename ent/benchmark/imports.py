@@ -0,0 +1,60 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+# Modules of the headless batch path (pool workers and the CLI) and the import time they may take
+IMPORT_BUDGETS: Dict[str, float] = {
+    'ent.job': 1.0,
+    'ent.main': 1.0,
+}
+
+# Plotting, clustering and database libraries, only imported on the code paths using them
+LAZY_MODULES = ('matplotlib', 'seaborn', 'cufflinks', 'plotly', 'lightweight_charts', 'sklearn', 'scipy',
+                'sqlalchemy')
+
+_PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': len(sys.modules),
+                  'loaded': [m for m in {lazy!r} if m in sys.modules],
+                  'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}}))
+'''
+
+
+def measure_import(module: str, repeat: int = 3) -> dict:
+    """
+        Import of `module` in fresh interpreters, as a spawned pool worker does it.
+        Example -> {'module': 'ent.job', 'seconds': 0.48, 'modules': 612, 'loaded': [], 'max_rss_bytes': ...}
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p if p else os.getcwd() for p in sys.path))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, lazy=LAZY_MODULES)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    return {'module': module,
+            'seconds': statistics.median(run['seconds'] for run in runs),
+            'modules': runs[-1]['modules'],
+            'loaded': runs[-1]['loaded'],
+            'max_rss_bytes': runs[-1]['max_rss_bytes']}
+
+
+def check_imports(budgets: Dict[str, float] = None, repeat: int = 3) -> List[dict]:
+    """
+        measure_import of every module of `budgets`; a module over its budget (seconds)
+        or loading any of LAZY_MODULES fails.
+    """
+    budgets = budgets if budgets else IMPORT_BUDGETS
+    results = []
+    for module, budget in budgets.items():
+        result = measure_import(module, repeat)
+        result['budget_s'] = budget
+        result['ok'] = result['seconds'] <= budget and not result['loaded']
+        results.append(result)
+    return results
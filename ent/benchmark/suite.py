@@ -0,0 +1,184 @@
+import datetime
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from ent.base_ds import BaseConfig, BacktestObject
+from ent.benchmark.generator import SyntheticDataGenerator
+from ent.repository import Repository
+from ent.service import DataProviderService, TradingDayService, GridService, GroupByCorrelationService, \
+    GroupByCorrelationService2, StrategyService
+from ent.trading_strategy import Strategy
+from ent.utils import get_stock_name
+
+
+class Fixture:
+    """
+        Synthetic file of `days` trading days and the intermediate results the scenarios start from.
+    """
+
+    def __init__(self, work_dir: str, days: int, seed: int, db_url: str = None):
+        self.days = days
+        self.file_path = SyntheticDataGenerator(seed).write_csv(os.path.join(work_dir, f'days_{days}'), days)
+        self.db_url = db_url if db_url else f'sqlite:///{os.path.join(work_dir, f"days_{days}", "bench.db")}'
+        self.config = BaseConfig().builder() \
+            .with_file_path(self.file_path) \
+            .with_sma_window(3) \
+            .with_type_vol(0.25) \
+            .with_depth(20) \
+            .with_coordinates_basis('close') \
+            .with_stop_loss(0.5) \
+            .with_use_cache(False) \
+            .build()
+        self.cached_config = BaseConfig(self.file_path, 3, 0.25, 20, 'close', 0.5, use_cache=True,
+                                        cache_dir=os.path.join(work_dir, f'days_{days}', 'cache'))
+        self.stock_name = get_stock_name(self.file_path)
+
+        self.data = DataProviderService(self.config).read_5min_data()
+        self.bars = self.data.five_min_bars
+        self.df = self.data.get_pandas_df()
+        self.trading_days = self.data.get_data_as_trading_days()
+        self.strategy_service = StrategyService(Strategy(sl=self.config.stop_loss, depth=self.config.depth))
+        self.grids = GridService(self.config.type_vol, self.config.depth, self.config.coordinates_basis,
+                                 self.df).get_positions_by_days(self.trading_days.keys())
+
+        trade_test_results = self.strategy_service.test_strategy_by_days(self.trading_days)
+        self.test_results = {trading_date: BacktestObject(trading_date, self.grids[trading_date],
+                                                          trade_test_results[trading_date])
+                             for trading_date in self.trading_days.keys() if trading_date in self.grids}
+        self.grouped = GroupByCorrelationService().group(self.test_results)
+
+        # Cache entry for the warm read
+        DataProviderService(self.cached_config).read_5min_data()
+
+    @property
+    def bars_count(self) -> int:
+        return len(self.data.bar_store)
+
+
+def _grid_get(fixture: Fixture):
+    config = fixture.config
+    for trading_date in fixture.trading_days.keys():
+        GridService(config.type_vol, config.depth, config.coordinates_basis, fixture.df.loc[trading_date]).get()
+
+
+def _strategy_get_results(fixture: Fixture):
+    for trading_day in fixture.trading_days.values():
+        fixture.strategy_service.test_strategy(trading_day)
+
+
+def _repository_write(fixture: Fixture, bulk: bool):
+    repo = Repository(url=fixture.db_url)
+    table_name = 'benchmark_bulk' if bulk else 'benchmark'
+    if bulk:
+        repo.bulk_save_pandas_df(table_name, fixture.grouped)
+    else:
+        repo.save_pandas_df(table_name, fixture.grouped)
+
+
+# Scenario name -> function of a Fixture. Names are stable, results are compared by them.
+SCENARIOS: Dict[str, Callable[[Fixture], object]] = {
+    'ingest.csv': lambda f: DataProviderService(f.config).read_5min_data(),
+    'ingest.cache': lambda f: DataProviderService(f.cached_config).read_5min_data(),
+    'days.group_bars_by_days': lambda f: TradingDayService.group_bars_by_days(f.bars, f.stock_name),
+    'days.group_store_by_days': lambda f: TradingDayService.group_store_by_days(f.data.bar_store, f.stock_name),
+    'grid.get': _grid_get,
+    'grid.get_positions_by_days': lambda f: GridService(
+        f.config.type_vol, f.config.depth, f.config.coordinates_basis, f.df).get_positions_by_days(),
+    'strategy.get_results': _strategy_get_results,
+    'strategy.get_results_batch': lambda f: f.strategy_service.test_strategy_by_days(f.trading_days),
+    'correlation.group': lambda f: GroupByCorrelationService().group(f.test_results),
+    'correlation.group2': lambda f: GroupByCorrelationService2().group(f.test_results),
+    'correlation.group2_sparse': lambda f: GroupByCorrelationService2(sparse=True).group(f.test_results),
+    'repository.save_pandas_df': lambda f: _repository_write(f, bulk=False),
+    'repository.bulk_save_pandas_df': lambda f: _repository_write(f, bulk=True),
+}
+
+
+class BenchmarkSuite:
+    """
+        Runs the SCENARIOS at several history sizes over synthetic data and reports
+        min / median / mean seconds of `repeat` runs as JSON.
+    """
+
+    def __init__(self, days: List[int] = (60, 250, 1000), repeat: int = 3, seed: int = 0,
+                 scenarios: List[str] = None, work_dir: str = None, db_url: str = None):
+        self.days = list(days)
+        self.repeat = repeat
+        self.seed = seed
+        self.scenarios = [name for name in SCENARIOS if not scenarios or any(name.startswith(s) for s in scenarios)]
+        self.work_dir = work_dir
+        self.db_url = db_url
+
+    @staticmethod
+    def environment() -> dict:
+        return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        }
+
+    def _time(self, function: Callable[[Fixture], object], fixture: Fixture) -> List[float]:
+        timings = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            function(fixture)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    def run(self) -> dict:
+        results = []
+        if self.work_dir:
+            os.makedirs(self.work_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.work_dir) as work_dir:
+            for days in self.days:
+                fixture = Fixture(work_dir, days, self.seed, self.db_url)
+                for name in self.scenarios:
+                    timings = self._time(SCENARIOS[name], fixture)
+                    results.append({
+                        'scenario': name,
+                        'days': days,
+                        'bars': fixture.bars_count,
+                        'repeat': self.repeat,
+                        'min_s': min(timings),
+                        'median_s': statistics.median(timings),
+                        'mean_s': statistics.fmean(timings),
+                    })
+
+        return {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'seed': self.seed,
+            'environment': self.environment(),
+            'results': results,
+        }
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 1.1) -> List[dict]:
+    """
+        Ratio current / baseline of min_s for every scenario and size present in both;
+        a ratio above `tolerance` is a regression.
+    """
+    previous = {(r['scenario'], r['days']): r for r in baseline['results']}
+    comparison = []
+    for r in current['results']:
+        before = previous.get((r['scenario'], r['days']))
+        if before is None:
+            continue
+        ratio = r['min_s'] / before['min_s'] if before['min_s'] > 0 else float('inf')
+        comparison.append({'scenario': r['scenario'], 'days': r['days'], 'baseline_s': before['min_s'],
+                           'current_s': r['min_s'], 'ratio': ratio, 'regression': ratio > tolerance})
+    return comparison
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,179 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from datetime import time
+from typing import List, Optional
+
+import numpy as np
+
+from ent.base_ds import BarStore
+from ent.utils import generate_file_path, log
+
+
+class BarCache:
+    """
+        On-disk cache of parsed, session-filtered bars: one .npy file per BarStore column
+        plus meta.json, in a directory per source file.
+
+        An entry is valid while the source file keeps its size and either its mtime
+        or its content hash (only computed when the mtime changed). Columns are loaded
+        with mmap, so a warm run does not parse anything.
+    """
+
+    version = 1
+    meta_file_name = 'meta.json'
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir if cache_dir else generate_file_path('cache')
+
+    def _entry_dir(self, file_path: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest())
+
+    @staticmethod
+    def content_hash(file_path: str) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _window(start_time: time, end_time: time) -> str:
+        return f'{start_time.isoformat()}-{end_time.isoformat()}'
+
+    def _read_meta(self, entry_dir: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(entry_dir, self.meta_file_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, entry_dir: str, meta: dict):
+        tmp_path = os.path.join(entry_dir, f'{self.meta_file_name}.{os.getpid()}')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(entry_dir, self.meta_file_name))
+
+    def _is_fresh(self, entry_dir: str, meta: dict) -> bool:
+        try:
+            stat = os.stat(meta['path'])
+        except OSError:
+            return False
+
+        if meta.get('version') != self.version or stat.st_size != meta['size']:
+            return False
+        if stat.st_mtime_ns == meta['mtime_ns']:
+            return True
+        if self.content_hash(meta['path']) != meta['hash']:
+            return False
+
+        # Touched but unchanged: remember the new mtime to skip hashing next time
+        meta['mtime_ns'] = stat.st_mtime_ns
+        self._write_meta(entry_dir, meta)
+        return True
+
+    def load(self, file_path: str, start_time: time, end_time: time) -> Optional[BarStore]:
+        entry_dir = self._entry_dir(file_path)
+        meta = self._read_meta(entry_dir)
+        if meta is None or meta['window'] != self._window(start_time, end_time) or not self._is_fresh(entry_dir, meta):
+            return None
+
+        try:
+            return BarStore(*[np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode='r')
+                              for name in BarStore.columns()])
+        except (OSError, ValueError):
+            return None
+
+    def save(self, file_path: str, start_time: time, end_time: time, store: BarStore) -> None:
+        stat = os.stat(file_path)
+        meta = {
+            'version': self.version,
+            'path': os.path.abspath(file_path),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'hash': self.content_hash(file_path),
+            'window': self._window(start_time, end_time),
+            'bars': len(store),
+        }
+
+        entry_dir = self._entry_dir(file_path)
+        tmp_dir = f'{entry_dir}.tmp-{os.getpid()}'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            for name in BarStore.columns():
+                np.save(os.path.join(tmp_dir, f'{name}.npy'), np.ascontiguousarray(getattr(store, name)))
+            self._write_meta(tmp_dir, meta)
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError as e:
+            log(f'Bars of {file_path} were not cached: {e}')
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_meta(self, file_path: str) -> Optional[dict]:
+        return self._read_meta(self._entry_dir(file_path))
+
+    def entry_paths(self, file_path: str) -> List[str]:
+        """
+            Files of the entry of a source file, empty if it isn't cached.
+        """
+        entry_dir = self._entry_dir(file_path)
+        if not os.path.isdir(entry_dir):
+            return []
+        return [os.path.join(entry_dir, name) for name in sorted(os.listdir(entry_dir))]
+
+    def invalidate(self, file_path: str = None) -> int:
+        """
+            Removes the entry of one source file, or the whole cache if file_path is None.
+            Returns the number of removed entries.
+        """
+        if file_path is not None:
+            entry_dir = self._entry_dir(file_path)
+            if not os.path.isdir(entry_dir):
+                return 0
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return 1
+
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        removed = len(os.listdir(self.cache_dir))
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        return removed
+
+    def cleanup(self) -> int:
+        """
+            Removes stale entries (source deleted or changed) and leftovers of interrupted writes.
+            Returns the number of removed entries.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return 0
+
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta = self._read_meta(entry_dir)
+            if '.tmp-' in name or meta is None or not self._is_fresh(entry_dir, meta):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the parsed bars cache')
+    parser.add_argument('--cache-dir', default=None)
+    commands = parser.add_subparsers(dest='command', required=True)
+    invalidate_parser = commands.add_parser('invalidate', help='drop entries of the given files (all if none given)')
+    invalidate_parser.add_argument('files', nargs='*')
+    commands.add_parser('cleanup', help='drop stale entries')
+    args = parser.parse_args()
+
+    cache = BarCache(args.cache_dir)
+    if args.command == 'invalidate':
+        count = sum(cache.invalidate(f) for f in args.files) if args.files else cache.invalidate()
+    else:
+        count = cache.cleanup()
+    log(f'Removed {count} cache entries from {cache.cache_dir}')
@@ -0,0 +1,197 @@
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+
+class CorrelationEngine:
+    """
+        Pairwise Pearson correlation of grid vectors computed with matrix products.
+
+        Vectors are bucketed by length (only vectors of equal length are compared),
+        each bucket is packed into a dense 2-D array and z-normalized, so that
+        correlation of two rows is their dot product. Products are taken in
+        row blocks of `block_size` to bound memory.
+
+        With `exact=True` pairs that pass the threshold (minus a small tolerance)
+        are re-evaluated with np.corrcoef, so values and threshold decisions are
+        identical to the per-pair computation.
+    """
+
+    tolerance = 1e-9
+
+    def __init__(self, block_size: int = 1024, exact: bool = True):
+        self.block_size = block_size
+        self.exact = exact
+
+    @staticmethod
+    def z_normalize(matrix: np.ndarray) -> np.ndarray:
+        centered = matrix - matrix.mean(axis=1, keepdims=True)
+        norms = np.sqrt(np.einsum('ij,ij->i', centered, centered))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return centered / norms[:, None]
+
+    @staticmethod
+    def bucket_by_length(vectors: Sequence[Sequence[float]]) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """
+            Example -> key:20, value: (positions of the vectors in input, matrix len(positions) x 20)
+        """
+        positions = {}
+        for i, vector in enumerate(vectors):
+            positions.setdefault(len(vector), []).append(i)
+
+        buckets = {}
+        for length, idx in positions.items():
+            buckets[length] = (np.asarray(idx, dtype=np.int64),
+                               np.asarray([vectors[i] for i in idx], dtype=np.float64).reshape(len(idx), length))
+        return buckets
+
+    def _iter_candidate_blocks(self, z: np.ndarray, threshold: float, first_row: int = 0):
+        # Lower triangle, row blocks from first_row on: yields (i, j, correlation) with i < j, j >= first_row
+        n = len(z)
+        cutoff = threshold - self.tolerance if self.exact else threshold
+        for start in range(first_row, n, self.block_size):
+            end = min(start + self.block_size, n)
+            tile = z[start:end] @ z[:end].T
+            rows, cols = np.nonzero(np.tril(tile > cutoff, k=start - 1))
+            yield cols, rows + start, tile[rows, cols]
+
+    def correlated_pairs(self,
+                         vectors: Sequence[Sequence[float]],
+                         threshold: float,
+                         index: Sequence[int] = None,
+                         new_from: int = 0) -> Dict[Tuple[int, int], float]:
+        """
+            Pairs (i, j), i < j, of equal-length vectors with correlation > threshold.
+            Keys are taken from `index` (positions by default) and ordered
+            lexicographically, as itertools.combinations would produce them.
+
+            With `new_from` only pairs with j >= new_from are computed, i.e. vectors appended
+            at the end are correlated against each other and the history before them
+            in O(new x history).
+        """
+        index = np.arange(len(vectors)) if index is None else np.asarray(index)
+
+        firsts, seconds, values = [], [], []
+        for positions, matrix in self.bucket_by_length(vectors).values():
+            z = self.z_normalize(matrix)
+            first_row = int(np.searchsorted(positions, new_from))
+            for rows, cols, corr in self._iter_candidate_blocks(z, threshold, first_row):
+                firsts.append(positions[rows])
+                seconds.append(positions[cols])
+                values.append(corr)
+
+        if not firsts:
+            return {}
+
+        firsts = np.concatenate(firsts)
+        seconds = np.concatenate(seconds)
+        values = np.concatenate(values)
+        order = np.lexsort((seconds, firsts))
+
+        correlated_pairs = {}
+        for i, j, corr in zip(firsts[order].tolist(), seconds[order].tolist(), values[order]):
+            if self.exact:
+                corr = np.corrcoef(vectors[i], vectors[j])[0, 1]
+            if corr > threshold:
+                correlated_pairs[(index[i].item(), index[j].item())] = corr
+        return correlated_pairs
+
+    def tile_pairs(self, z: np.ndarray, matrix: np.ndarray, rows: Tuple[int, int], cols: Tuple[int, int],
+                   threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+            Pairs (i, j), i < j, with correlation > threshold, i in [rows[0], rows[1]) and j in [cols[0], cols[1]),
+            of z-normalized rows `z` (`matrix` holds the raw ones for the exact check).
+            Tiles over all block pairs with row block <= column block cover every pair once.
+        """
+        cutoff = threshold - self.tolerance if self.exact else threshold
+        tile = z[rows[0]:rows[1]] @ z[cols[0]:cols[1]].T
+        i, j = np.nonzero(tile > cutoff)
+        corr = tile[i, j]
+        i, j = i + rows[0], j + cols[0]
+        keep = i < j
+        i, j, corr = i[keep], j[keep], corr[keep]
+
+        if self.exact:
+            corr = np.array([np.corrcoef(matrix[a], matrix[b])[0, 1] for a, b in zip(i.tolist(), j.tolist())],
+                            dtype=np.float64)
+        keep = corr > threshold
+        return i[keep], j[keep], corr[keep]
+
+    def _refine_near_threshold(self, matrix: np.ndarray, rows, cols, corr, threshold: float):
+        if self.exact:
+            for k in np.flatnonzero(np.abs(corr - threshold) < self.tolerance):
+                corr[k] = np.corrcoef(matrix[rows[k]], matrix[cols[k]])[0, 1]
+        return corr
+
+    def correlation_matrix(self, vectors: Sequence[Sequence[float]], threshold: float = None) -> np.ndarray:
+        """
+            Dense n x n correlation matrix of equal-length vectors, filled in row blocks.
+            When `threshold` is given, entries close to it are recomputed with np.corrcoef.
+        """
+        matrix = np.asarray(vectors, dtype=np.float64)
+        z = self.z_normalize(matrix)
+        n = len(z)
+        correlation_matrix = np.empty((n, n))
+        for start in range(0, n, self.block_size):
+            end = min(start + self.block_size, n)
+            tile = correlation_matrix[start:end]
+            np.matmul(z[start:end], z.T, out=tile)
+            if threshold is not None:
+                rows, cols = np.nonzero(np.abs(tile - threshold) < self.tolerance)
+                tile[rows, cols] = self._refine_near_threshold(matrix, rows + start, cols, tile[rows, cols], threshold)
+        np.clip(correlation_matrix, -1, 1, out=correlation_matrix)
+        np.fill_diagonal(correlation_matrix, 1.0)
+        return correlation_matrix
+
+    def mean_correlation(self, vectors: Sequence[Sequence[float]]) -> float:
+        """
+            Mean correlation over all pairs i != j of equal-length vectors, without the g x g matrix:
+            sum_{i != j} z_i . z_j = |sum_i z_i|^2 - sum_i |z_i|^2, in O(g x length) memory.
+        """
+        z = self.z_normalize(np.asarray(vectors, dtype=np.float64))
+        g = len(z)
+        total = z.sum(axis=0)
+        return float((total @ total - np.einsum('ij,ij->', z, z)) / (g * (g - 1)))
+
+    def radius_graph(self, vectors: Sequence[Sequence[float]], threshold: float):
+        """
+            Sparse CSR matrix of distances 1 - correlation between equal-length vectors,
+            holding only neighbours within eps = 1 - threshold (explicit zeros kept).
+            Suitable for DBSCAN(metric='precomputed', eps=1 - threshold).
+        """
+        from scipy.sparse import csr_matrix
+
+        matrix = np.asarray(vectors, dtype=np.float64)
+        z = self.z_normalize(matrix)
+        n = len(z)
+        eps = 1 - threshold
+        cutoff = threshold - self.tolerance if self.exact else threshold
+
+        counts = np.zeros(n, dtype=np.int64)
+        indices, distances = [], []
+        for start in range(0, n, self.block_size):
+            end = min(start + self.block_size, n)
+            tile = z[start:end] @ z.T
+            rows, cols = np.nonzero(tile > cutoff)
+            corr = self._refine_near_threshold(matrix, rows + start, cols, np.clip(tile[rows, cols], -1, 1), threshold)
+            dist = 1 - corr
+            keep = (dist <= eps) & (rows + start != cols)
+            counts[start:end] = np.bincount(rows[keep], minlength=end - start)
+            indices.append(cols[keep])
+            distances.append(dist[keep])
+
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return csr_matrix((np.concatenate(distances) if distances else np.empty(0),
+                           np.concatenate(indices) if indices else np.empty(0, dtype=np.int64),
+                           indptr), shape=(n, n))
+
+
+def correlate_tile(z_path: str, matrix_path: str, rows: Tuple[int, int], cols: Tuple[int, int], threshold: float,
+                   exact: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        CorrelationEngine.tile_pairs() over .npy matrices shared through memory mapping,
+        so a worker process only pages in the two row blocks of its tile.
+    """
+    z = np.load(z_path, mmap_mode='r')
+    matrix = np.load(matrix_path, mmap_mode='r')
+    return CorrelationEngine(exact=exact).tile_pairs(z, matrix, rows, cols, threshold)
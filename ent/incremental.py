@@ -0,0 +1,89 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ent.base_ds import BaseConfig
+from ent.utils import generate_file_path, get_stock_name
+
+
+class IncrementalState:
+    """
+        Everything needed to extend the results of one stock by new trading days:
+        per-day rows (date, grid, strategy results), correlated pairs keyed by row position
+        and correlated groups of positions.
+    """
+
+    def __init__(self, data: pd.DataFrame = None, pairs: Dict[Tuple[int, int], float] = None,
+                 groups: List[set] = None):
+        self.data = data if data is not None else pd.DataFrame()
+        self.pairs = pairs if pairs is not None else {}
+        self.groups = groups if groups is not None else []
+
+    def dates(self) -> set:
+        return set(self.data['date']) if len(self.data) else set()
+
+
+class IncrementalStateStore:
+    """
+        Directory per stock and parameter set with the IncrementalState of the last run:
+            data.pkl - per-day rows
+            pairs.npz - i, j, corr arrays of correlated pairs
+            groups.json - list of groups
+        Written to a staging directory first and swapped in, so an interrupted run leaves the previous state.
+    """
+
+    def __init__(self, config: BaseConfig, state_dir: str = None):
+        self.state_dir = state_dir if state_dir else generate_file_path('state')
+        self.path = os.path.join(self.state_dir, f'{get_stock_name(config.file_path)}-{self.params_hash(config)}')
+
+    @staticmethod
+    def params_hash(config: BaseConfig) -> str:
+        params = [os.path.abspath(config.file_path), config.sma_window, config.type_vol, config.depth,
+                  config.coordinates_basis, config.stop_loss]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()[:12]
+
+    def load(self) -> IncrementalState:
+        if not os.path.isdir(self.path):
+            return IncrementalState()
+
+        data = pd.read_pickle(os.path.join(self.path, 'data.pkl'))
+        with np.load(os.path.join(self.path, 'pairs.npz')) as pairs:
+            pairs = {(int(i), int(j)): corr for i, j, corr in zip(pairs['i'], pairs['j'], pairs['corr'].tolist())}
+        with open(os.path.join(self.path, 'groups.json')) as f:
+            groups = [set(group) for group in json.load(f)]
+        return IncrementalState(data, pairs, groups)
+
+    def save(self, state: IncrementalState) -> None:
+        self.commit(self.stage(state))
+
+    def stage(self, state: IncrementalState) -> str:
+        """
+            Writes `state` to a staging directory next to the current one, swapped in by commit()
+            once the rows of the run are written. Staged states of earlier runs whose rows weren't
+            written are removed first.
+        """
+        for stale in glob.glob(f'{glob.escape(self.path)}.staged-*'):
+            shutil.rmtree(stale, ignore_errors=True)
+        staged_path = f'{self.path}.staged-{os.getpid()}'
+        os.makedirs(staged_path)
+        try:
+            state.data.to_pickle(os.path.join(staged_path, 'data.pkl'))
+            keys = np.array(list(state.pairs.keys()), dtype=np.int64).reshape(-1, 2)
+            np.savez(os.path.join(staged_path, 'pairs.npz'), i=keys[:, 0], j=keys[:, 1],
+                     corr=np.array(list(state.pairs.values()), dtype=np.float64))
+            with open(os.path.join(staged_path, 'groups.json'), 'w') as f:
+                json.dump([sorted(group) for group in state.groups], f)
+        except Exception:
+            shutil.rmtree(staged_path, ignore_errors=True)
+            raise
+        return staged_path
+
+    def commit(self, staged_path: str) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(staged_path, self.path)
@@ -1,9 +1,20 @@
 import datetime
+import os
+import tempfile
 from abc import abstractmethod, ABC
-from typing import List
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
-from ent.base_ds import BaseConfig, BacktestObject
+import numpy as np
+import pandas as pd
+
+from ent.base_ds import BaseConfig, BacktestObject, SweepConfig
+from ent.base_mapper import BarMapper
+from ent.correlation import CorrelationEngine, correlate_tile
+from ent.incremental import IncrementalState, IncrementalStateStore
+from ent.metrics import metrics
 from ent.repository import Repository
+from ent.scheduler import JobScheduler, Task
 from ent.service import DataProviderService, VisualizingService, StrategyService, GridService, \
     GroupByCorrelationService
 from ent.trading_strategy import Strategy
@@ -11,50 +22,327 @@ from ent.utils import get_stock_name, log
 
 
 class Job(ABC):
+    repo: Repository = None
+    # Set by compute() of jobs that keep state: called (picklable) once the rows it returned are written
+    on_written: Callable[[], None] = None
 
     @abstractmethod
     def execute(self):
         pass
 
+    def get_repo(self) -> Repository:
+        # Created on first write only, jobs whose results are written by the parent never connect
+        if self.repo is None:
+            self.repo = Repository('iamdefault', '12345', 'logos')
+        return self.repo
+
 
 class GroupByCorrelationPerStockJob(Job):
 
     def __init__(self, config: BaseConfig):
         self.config = config
-        self.repo = Repository('iamdefault', '12345', 'logos')
         self.target_db_table_name = 'group_by_correlation_per_stock'
 
     def execute(self):
+        df = self.compute()
+        with metrics.stage('write', get_stock_name(self.config.file_path), len(df)):
+            self.get_repo().bulk_save_pandas_df(self.target_db_table_name, df)
+        if self.on_written is not None:
+            self.on_written()
+
+    def compute(self) -> pd.DataFrame:
+        return self.group(self.backtest(), get_stock_name(self.config.file_path))
+
+    def backtest(self, date_from: str = None, date_to: str = None, skip_dates: Set[str] = None) \
+            -> Dict[str, BacktestObject]:
+        """
+            Grids and strategy results of the trading days within [date_from, date_to] (all by default),
+            except `skip_dates`. Results of consecutive date ranges can be merged and passed to group().
+            With config.read_chunk_rows bars are streamed and processed chunk by chunk of complete days,
+            so only one chunk of bars is in memory along with the per-day results.
+        """
 
         log(f'Starting #GroupByCorrelationPerStockJob for stock: {get_stock_name(self.config.file_path)}')
 
-        data = DataProviderService(self.config).read_5min_data()
         strategy_service = StrategyService(Strategy(sl=self.config.stop_loss, depth=self.config.depth))
 
-        data_as_df = data.get_pandas_df()
-        data_as_td = data.get_data_as_trading_days()
-
         test_results = {}
+        for data in self._read():
+            test_results.update(self._backtest_chunk(data, strategy_service, date_from, date_to, skip_dates))
+        return test_results
+
+    def _read(self) -> Iterator[DataProviderService]:
+        stock_name = get_stock_name(self.config.file_path)
+        provider = DataProviderService(self.config)
+        shared = self.config.shared_bars
+        # Shared bars of some days (a chunk of a ticker) are read at once, with the opens before them
+        if not self.config.read_chunk_rows or (shared is not None and not shared.whole):
+            with metrics.stage('read', stock_name) as stage:
+                provider.read_5min_data()
+                stage.rows = len(provider.bar_store)
+            yield provider
+            return
+
+        chunks = provider.stream_5min_data(self.config.read_chunk_rows)
+        while True:
+            with metrics.stage('read', stock_name) as stage:
+                data = next(chunks, None)
+                stage.rows = 0 if data is None else len(data.bar_store)
+            if data is None:
+                return
+            yield data
 
-        for trading_date, trading_day in data_as_td.items():
-            if trading_date in data_as_df.index:
+    def _backtest_chunk(self, data: DataProviderService, strategy_service: StrategyService,
+                        date_from: str, date_to: str, skip_dates: Set[str]) -> Dict[str, BacktestObject]:
+        stock_name = get_stock_name(self.config.file_path)
+        if date_from is not None or date_to is not None:
+            # Days, frame and grids are built for the date range only, not for all bars read
+            data = data.between(date_from, date_to)
+        with metrics.stage('days', stock_name) as stage:
+            data_as_td = {trading_date: trading_day
+                          for trading_date, trading_day in data.get_data_as_trading_days().items()
+                          if (date_from is None or trading_date >= date_from) and
+                          (date_to is None or trading_date <= date_to) and
+                          (skip_dates is None or trading_date not in skip_dates)}
+            stage.rows = len(data_as_td)
+        if not data_as_td:
+            return {}
 
-                trade_test_result = strategy_service.test_strategy(trading_day)
+        with metrics.stage('frame', stock_name, len(data.bar_store)):
+            data_as_df = data.get_pandas_df()
 
-                grid = GridService(
-                    self.config.type_vol, self.config.depth, self.config.coordinates_basis, data_as_df.loc[trading_date]
-                ).get()
+        with metrics.stage('grid', stock_name) as stage:
+            grids = GridService(
+                self.config.type_vol, self.config.depth, self.config.coordinates_basis, data_as_df
+            ).get_positions_by_days(data_as_td.keys())
+            stage.rows = len(grids)
 
-                test_results[trading_date] = BacktestObject(trading_date, grid, trade_test_result)
+        with metrics.stage('strategy', stock_name, len(data_as_td)):
+            trade_test_results = strategy_service.test_strategy_by_days(data_as_td)
+
+        test_results = {}
+
+        for trading_date in data_as_td.keys():
+            if trading_date in grids:
+                test_results[trading_date] = BacktestObject(
+                    trading_date, grids[trading_date], trade_test_results[trading_date])
             else:
                 print(f"Trading date {trading_date} not found in DataFrame index")
 
-        df = GroupByCorrelationService().group(test_results)
+        return test_results
+
+    @staticmethod
+    def group(test_results: Dict[str, BacktestObject], stock_name: str = None) -> pd.DataFrame:
+        service = GroupByCorrelationService()
+        with metrics.stage('correlation', stock_name) as stage:
+            correlated = service.correlate([backtest.grid for backtest in test_results.values()])
+            stage.rows = len(correlated[0])
+        with metrics.stage('grouping', stock_name) as stage:
+            df = service.group(test_results, correlated)
+            stage.rows = len(df)
         curr_time = datetime.datetime.now()
 
         df['processing_time'] = curr_time
 
-        self.repo.save_pandas_df(self.target_db_table_name, df)
+        return df
+
+
+class IncrementalGroupByCorrelationJob(GroupByCorrelationPerStockJob):
+    """
+        Daily mode of GroupByCorrelationPerStockJob: per-day results and correlation state are kept
+        in an IncrementalStateStore, and a run only backtests the dates that are new in the source file.
+        New grids are correlated against the stored history and inserted into the existing groups,
+        so a run costs O(new x history) instead of O(history^2).
+
+        Only rows of groups created or extended by the new days are returned.
+        The first run (no state yet) returns the same rows as GroupByCorrelationPerStockJob.
+        compute() only stages the new state; on_written swaps it in after the rows were written,
+        so days whose rows didn't reach the database are processed again by the next run.
+    """
+
+    def __init__(self, config: BaseConfig, state_dir: str = None):
+        super().__init__(config)
+        self.state_store = IncrementalStateStore(config, state_dir)
+
+    def compute(self) -> pd.DataFrame:
+        state = self.state_store.load()
+        test_results = self.backtest(skip_dates=state.dates())
+        if not test_results:
+            log(f'No new trading days for stock: {get_stock_name(self.config.file_path)}')
+            return pd.DataFrame()
+
+        new_data = BarMapper.test_results_to_pandas_df(test_results)
+        data = pd.concat([state.data, new_data], ignore_index=True) if len(state.data) else new_data
+        service = GroupByCorrelationService()
+        pairs, groups, touched_groups = service.correlate_new(
+            data['grid'].tolist(), len(state.data), (state.pairs, state.groups))
+
+        df = service.group_rows(data, pairs, touched_groups)
+        df['processing_time'] = datetime.datetime.now()
+
+        staged_path = self.state_store.stage(IncrementalState(data, pairs, groups))
+        self.on_written = partial(self.state_store.commit, staged_path)
+        return df
+
+
+def _backtest_stock(config: BaseConfig) -> Tuple[pd.DataFrame, Optional[List[dict]]]:
+    return BarMapper.test_results_to_pandas_df(GroupByCorrelationPerStockJob(config).backtest()), metrics.drain()
+
+
+class CrossStockGroupByCorrelationJob(Job):
+    """
+        Groups trading days of all stocks together, so groups can span stocks.
+
+        Per-stock backtests run in a process pool. Their grid vectors are gathered into memory-mapped
+        .npy matrices (one per vector length, z-normalized and raw) in `work_dir`, and correlated pairs
+        are computed in block_size x block_size tiles by pool workers, which map the shared files
+        instead of receiving copies. A worker holds one tile at a time, so its memory is bounded by
+        block_size, not by the size of the universe.
+    """
+
+    def __init__(self, configs: List[BaseConfig], scheduler: JobScheduler = None, block_size: int = 2048,
+                 work_dir: str = None):
+        self.configs = configs
+        self.scheduler = scheduler if scheduler else JobScheduler()
+        self.block_size = block_size
+        self.work_dir = work_dir
+        self.target_db_table_name = 'group_by_correlation_cross_stock'
+
+    def execute(self):
+        self.get_repo().bulk_save_pandas_df(self.target_db_table_name, self.compute())
+
+    def compute(self) -> pd.DataFrame:
+        log(f'Starting #CrossStockGroupByCorrelationJob for {len(self.configs)} stocks')
+
+        data = self.backtest()
+        threshold = GroupByCorrelationService.correlation_threshold
+        with tempfile.TemporaryDirectory(dir=self.work_dir) as work_dir:
+            correlated_pairs = self.correlate(data['grid'].tolist(), threshold, work_dir)
+        correlated_groups = GroupByCorrelationService._find_correlated_groups(correlated_pairs, threshold)
+
+        df = GroupByCorrelationService.group_rows(data, correlated_pairs, correlated_groups)
+        df['processing_time'] = datetime.datetime.now()
+        return df
+
+    def backtest(self) -> pd.DataFrame:
+        """
+            Per-day rows of all stocks, in configs order.
+        """
+        tasks = [Task(self.scheduler.estimate_bars(config), _backtest_stock, (config,), config.file_path)
+                 for config in self.configs]
+        frames = {}
+        for task, future in self.scheduler.run(tasks):
+            frames[task.name], records = future.result()
+            metrics.extend(records)
+        return pd.concat([frames[config.file_path] for config in self.configs], ignore_index=True)
+
+    def correlate(self, grids: list, threshold: float, work_dir: str) -> Dict[Tuple[int, int], float]:
+        """
+            Same pairs as CorrelationEngine.correlated_pairs(), computed by tiles in the process pool.
+        """
+        vectors = [GroupByCorrelationService._convert_grid_to_numerical(grid) for grid in grids]
+
+        tasks, bucket_positions = [], {}
+        for length, (positions, matrix) in CorrelationEngine.bucket_by_length(vectors).items():
+            matrix_path = os.path.join(work_dir, f'matrix_{length}.npy')
+            z_path = os.path.join(work_dir, f'z_{length}.npy')
+            for path, values in ((matrix_path, matrix), (z_path, CorrelationEngine.z_normalize(matrix))):
+                shared = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=values.shape)
+                shared[:] = values
+                shared.flush()
+                del shared
+
+            bucket_positions[z_path] = positions
+            starts = range(0, len(positions), self.block_size)
+            for row_start in starts:
+                for col_start in starts[row_start // self.block_size:]:
+                    rows = (row_start, min(row_start + self.block_size, len(positions)))
+                    cols = (col_start, min(col_start + self.block_size, len(positions)))
+                    tasks.append(Task((rows[1] - rows[0]) * (cols[1] - cols[0]), correlate_tile,
+                                      (z_path, matrix_path, rows, cols, threshold), f'{length}:{rows}x{cols}'))
+
+        firsts, seconds, values = [], [], []
+        for task, future in self.scheduler.run(tasks):
+            i, j, corr = future.result()
+            positions = bucket_positions[task.args[0]]
+            firsts.append(positions[i])
+            seconds.append(positions[j])
+            values.append(corr)
+
+        if not firsts:
+            return {}
+
+        firsts, seconds, values = np.concatenate(firsts), np.concatenate(seconds), np.concatenate(values)
+        order = np.lexsort((seconds, firsts))
+        return dict(zip(zip(firsts[order].tolist(), seconds[order].tolist()), values[order]))
+
+
+class ParameterSweepJob(Job):
+    """
+        Runs every parameter combination of a SweepConfig over one file.
+
+        Bars are read once. Each stage is cached by the parameters it depends on
+        and only recomputed when they change:
+            grids and correlated groups - type_vol, depth, coordinates_basis (and sma_window for 'sma' basis)
+            strategy results - stop_loss, depth
+    """
+
+    def __init__(self, sweep: SweepConfig):
+        self.sweep = sweep
+        self.target_db_table_name = 'group_by_correlation_sweep'
+
+    def run(self) -> Iterator[Tuple[BaseConfig, pd.DataFrame]]:
+        configs = self.sweep.configs()
+        data = DataProviderService(configs[0]).read_5min_data()
+        data_as_td = data.get_data_as_trading_days()
+
+        frames, grids, correlated, trade_test_results = {}, {}, {}, {}
+        for config in configs:
+            sma_key = config.sma_window if config.coordinates_basis == 'sma' else None
+            grid_key = (config.type_vol, config.depth, config.coordinates_basis, sma_key)
+            strategy_key = (config.stop_loss, config.depth)
+
+            if grid_key not in grids:
+                if sma_key not in frames:
+                    frames[sma_key] = data.get_pandas_df(config.sma_window)
+                grids[grid_key] = GridService(
+                    config.type_vol, config.depth, config.coordinates_basis, frames[sma_key]
+                ).get_positions_by_days(data_as_td.keys())
+                correlated[grid_key] = GroupByCorrelationService().correlate(
+                    [grids[grid_key][trading_date] for trading_date in data_as_td.keys() if
+                     trading_date in grids[grid_key]])
+
+            if strategy_key not in trade_test_results:
+                trade_test_results[strategy_key] = StrategyService(
+                    Strategy(sl=config.stop_loss, depth=config.depth)
+                ).test_strategy_by_days(data_as_td)
+
+            test_results = {
+                trading_date: BacktestObject(trading_date, grids[grid_key][trading_date],
+                                             trade_test_results[strategy_key][trading_date])
+                for trading_date in data_as_td.keys() if trading_date in grids[grid_key]
+            }
+            yield config, GroupByCorrelationService().group(test_results, correlated[grid_key])
+
+    def execute(self):
+        self.get_repo().bulk_save_pandas_df(self.target_db_table_name, self.compute())
+
+    def compute(self) -> pd.DataFrame:
+
+        log(f'Starting #ParameterSweepJob for stock: {get_stock_name(self.sweep.file_path)}')
+
+        curr_time = datetime.datetime.now()
+        dfs = []
+        for config, df in self.run():
+            df['sma_window'] = config.sma_window
+            df['type_vol'] = config.type_vol
+            df['depth'] = config.depth
+            df['coordinates_basis'] = config.coordinates_basis
+            df['stop_loss'] = config.stop_loss
+            df['processing_time'] = curr_time
+            dfs.append(df)
+
+        return pd.concat(dfs, ignore_index=True)
 
 
 class VisualiseJob(Job):
@@ -66,3 +354,21 @@ class VisualiseJob(Job):
     def execute(self):
         data = DataProviderService(self.config).read_5min_data().get_data_as_trading_days()
         VisualizingService(data).visualise_days(self.days)
+
+
+class ExportGroupChartsJob(Job):
+    """
+        Exports charts of every day of the correlation groups of one stock,
+        as grouped by GroupByCorrelationPerStockJob, to <output_dir>/<group>/.
+    """
+
+    def __init__(self, config: BaseConfig, grouped: pd.DataFrame, output_dir: str, max_workers: int = None):
+        self.config = config
+        self.grouped = grouped
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+
+    def execute(self) -> List[str]:
+        data = DataProviderService(self.config).read_5min_data().get_data_as_trading_days()
+        groups = {group: [str(date) for date in rows['date']] for group, rows in self.grouped.groupby('group', sort=False)}
+        return VisualizingService(data).export_groups(groups, self.output_dir, self.max_workers)
@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import datetime
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from ent.base_ds import BaseConfig, Bar, TestResults
+from ent.base_mapper import BarMapper
+from ent.job import GroupByCorrelationPerStockJob
+from ent.metrics import metrics
+from ent.service import DataProviderService, GridService
+from ent.session_index import SessionIndex
+from ent.utils import generate_file_path, get_stock_name, log
+
+
+class BarSource(ABC):
+    """
+        Bars of one stock in time order, as they print.
+    """
+
+    @abstractmethod
+    def bars(self) -> AsyncIterator[Bar]:
+        pass
+
+
+class QueueSource(BarSource):
+    """
+        Bars put on an asyncio queue by a feed, until it puts None.
+    """
+
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+
+    async def bars(self) -> AsyncIterator[Bar]:
+        while True:
+            bar = await self.queue.get()
+            if bar is None:
+                return
+            yield bar
+
+
+class CsvTailSource(BarSource):
+    """
+        Lines appended to a source_data CSV by a recorder, polled every `poll_interval` seconds.
+        Starts at the end of the file, or at its first bar with `from_start`. A partially written
+        last line is kept until its newline arrives.
+    """
+
+    def __init__(self, file_path: str, poll_interval: float = 1.0, from_start: bool = False):
+        self.file_path = file_path
+        self.poll_interval = poll_interval
+        self.from_start = from_start
+
+    async def bars(self) -> AsyncIterator[Bar]:
+        with open(self.file_path) as f:
+            if self.from_start:
+                f.readline()
+            else:
+                f.seek(0, os.SEEK_END)
+
+            pending = ''
+            while True:
+                chunk = f.read()
+                if not chunk:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                *lines, pending = (pending + chunk).split('\n')
+                for line in lines:
+                    row = line.strip().split(',')
+                    bar = BarMapper.list_to_bar(row) if len(row) > 7 else None
+                    if bar is not None:
+                        yield bar
+
+
+async def replay(bars: Iterable[Bar], queue: asyncio.Queue, interval: float = 0.0) -> None:
+    """
+        Local stand-in of a feed: puts historical bars on the queue of a QueueSource,
+        `interval` seconds apart, then None.
+    """
+    for bar in bars:
+        await queue.put(bar)
+        await asyncio.sleep(interval)
+    await queue.put(None)
+
+
+class LiveGridState:
+    """
+        Grid of the current session, updated bar by bar in O(depth): running high / low of the day
+        and the coordinates basis of its first `depth` bars, as GridService computes them on complete
+        days. The sma basis continues over days from the opens of `preceding_open`.
+
+        Until the session closes the grid step comes from the high / low so far, so positions are the
+        ones of GridService for the day cut at the last bar; with all bars they are equal (with the sma
+        basis up to float rounding of the rolling mean, which can move a value lying on a grid line).
+    """
+
+    basis_fields = {'open': 'price_open', 'high': 'price_high', 'low': 'price_low', 'close': 'price_close'}
+
+    def __init__(self, type_vol: float, depth: int, coordinates_basis: str, sma_window: int = None,
+                 preceding_open: np.ndarray = None):
+        if coordinates_basis != 'sma' and coordinates_basis not in self.basis_fields:
+            raise ValueError(f'Unknown coordinates basis: {coordinates_basis}')
+        self.type_vol = type_vol
+        self.depth = depth
+        self.coordinates_basis = coordinates_basis
+        self.opens = deque(preceding_open[len(preceding_open) - (sma_window or 1) + 1:].tolist()
+                           if preceding_open is not None and sma_window else [], maxlen=sma_window or 1)
+
+        self.date: datetime.date = None
+        self.last_time: datetime.datetime = None
+        self.bars = 0
+        self.high = np.nan
+        self.low = np.nan
+        self.values = np.full(depth, np.nan)
+
+    def _reset(self, date: datetime.date) -> None:
+        self.date = date
+        self.bars = 0
+        self.high = np.nan
+        self.low = np.nan
+        self.values[:] = np.nan
+
+    def update(self, bar: Bar) -> bool:
+        """
+            Adds a bar of the session (start_time < time < end_time of DataProviderService, with a low),
+            a bar of a new date starts a new day. Returns False for bars that are skipped.
+        """
+        if bar.price_low is None or (self.last_time is not None and bar.date_time <= self.last_time) or \
+                not DataProviderService.start_time < bar.date_time.time() < DataProviderService.end_time:
+            return False
+        if bar.date_time.date() != self.date:
+            self._reset(bar.date_time.date())
+        self.last_time = bar.date_time
+
+        if self.coordinates_basis == 'sma':
+            self.opens.append(np.nan if bar.price_open is None else bar.price_open)
+            value = sum(self.opens) / len(self.opens) if len(self.opens) == self.opens.maxlen else np.nan
+        else:
+            value = getattr(bar, self.basis_fields[self.coordinates_basis])
+
+        if self.bars < self.depth:
+            self.values[self.bars] = np.nan if value is None else value
+        self.high = np.fmax(self.high, np.nan if bar.price_high is None else bar.price_high)
+        self.low = np.fmin(self.low, bar.price_low)
+        self.bars += 1
+        return True
+
+    def positions(self) -> Optional[np.ndarray]:
+        """
+            uint16 grid row of GridService.get_positions_by_days, None before `depth` bars
+            or while the day has no range.
+        """
+        if self.bars < self.depth:
+            return None
+
+        valid = ~np.isnan(self.values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid_height = np.ceil((self.high - self.low) / self.type_vol)
+            grid_step = (self.high - self.low) / grid_height
+            positions = np.trunc((self.values - np.fmin.reduce(self.values)) / grid_step)
+        if not valid.any() or not np.isfinite(grid_step):
+            return None
+
+        positions = np.where(valid, positions, GridService.MISSING)
+        if positions[valid].max(initial=0) >= GridService.MISSING:
+            raise ValueError(f"Grid positions don't fit uint16, type_vol={self.type_vol} is too small")
+        return positions.astype(np.uint16)
+
+
+class SessionHistory:
+    """
+        Grids (in a SessionIndex) and Strategy outcomes of historical sessions, computed once
+        at start, so live lookups never recompute history.
+    """
+
+    def __init__(self, index: SessionIndex, outcomes: Dict[Tuple[str, str], TestResults]):
+        self.index = index
+        self.outcomes = outcomes
+
+    @classmethod
+    def build(cls, configs: List[BaseConfig], date_to: str = None) -> 'SessionHistory':
+        """
+            Sessions of the configs' files up to `date_to` (all by default); configs must share grid parameters.
+        """
+        index = SessionIndex(SessionIndex.grid_params(configs[0]))
+        outcomes = {}
+        grids = []
+        for config in configs:
+            if SessionIndex.grid_params(config) != index.params:
+                raise ValueError(f'Grid parameters of {config.file_path} differ from {index.params}')
+
+            stock_name = get_stock_name(config.file_path)
+            backtest = GroupByCorrelationPerStockJob(config).backtest(date_to=date_to)
+            grids.append((stock_name, {date: backtest_object.grid for date, backtest_object in backtest.items()}))
+            outcomes.update({(stock_name, date): backtest_object.trade_test_result
+                             for date, backtest_object in backtest.items()})
+        index.add_all(grids)
+        return cls(index, outcomes)
+
+    def similar(self, positions: np.ndarray, k: int = 10, stock_names: Iterable[str] = None,
+                exclude: Tuple[str, str] = None) -> List[Tuple[str, str, float, Optional[TestResults]]]:
+        """
+            k most correlated sessions and their outcomes, without the `exclude` session.
+            Example -> [('ABC', '2021-11-04', 0.97, TestResults(...)), ...]
+        """
+        return [(stock_name, date, correlation, self.outcomes.get((stock_name, date)))
+                for stock_name, date, correlation in self.index.query(positions, k + 1, stock_names)
+                if (stock_name, date) != exclude][:k]
+
+
+class LiveMatch:
+
+    def __init__(self, stock_name: str, date: str, bars: int, grid: str,
+                 matches: List[Tuple[str, str, float, Optional[TestResults]]], latency: float):
+        self.stock_name = stock_name
+        self.date = date
+        self.bars = bars
+        self.grid = grid
+        self.matches = matches
+        self.latency = latency
+
+    def __str__(self):
+        return (f"LiveMatch(stock={self.stock_name}, "
+                f"date={self.date}, "
+                f"bars={self.bars}, "
+                f"grid={self.grid}, "
+                f"matches={len(self.matches)}, "
+                f"latency={self.latency * 1000:.2f}ms)")
+
+
+class LiveSession:
+    """
+        Live mode of one stock: every bar updates the LiveGridState, and once `depth` bars of the day
+        have arrived the most correlated historical sessions are looked up, again whenever the grid
+        changes (a new high or low can move positions). Work per bar is the grid update plus at most
+        one index query, independent of the length of the day or of history.
+        Example -> await LiveSession(config, SessionHistory.build(configs)).run(QueueSource(queue), print)
+    """
+
+    def __init__(self, config: BaseConfig, history: SessionHistory, k: int = 10,
+                 stock_names: Iterable[str] = None, preceding_open: np.ndarray = None):
+        self.stock_name = get_stock_name(config.file_path)
+        self.history = history
+        self.k = k
+        self.stock_names = list(stock_names) if stock_names is not None else None
+        self.state = LiveGridState(config.type_vol, config.depth, config.coordinates_basis, config.sma_window,
+                                   preceding_open)
+        self._looked_up: np.ndarray = None
+
+    def on_bar(self, bar: Bar) -> Optional[LiveMatch]:
+        start = time.perf_counter()
+        with metrics.stage('live', self.stock_name) as stage:
+            date = self.state.date
+            if not self.state.update(bar):
+                return None
+            if self.state.date != date:
+                self._looked_up = None
+
+            positions = self.state.positions()
+            if positions is None or (self._looked_up is not None and np.array_equal(positions, self._looked_up)):
+                return None
+            self._looked_up = positions
+
+            date = str(self.state.date)
+            matches = self.history.similar(positions, self.k, self.stock_names, exclude=(self.stock_name, date))
+            stage.rows = len(matches)
+        return LiveMatch(self.stock_name, date, self.state.bars, GridService.to_string(positions), matches,
+                         time.perf_counter() - start)
+
+    async def run(self, source: BarSource, on_match: Callable[[LiveMatch], None]) -> None:
+        async for bar in source.bars():
+            match = self.on_bar(bar)
+            if match is not None:
+                on_match(match)
+
+
+def _print_match(match: LiveMatch) -> None:
+    log(match)
+    for stock_name, date, correlation, outcome in match.matches:
+        log(f'    {stock_name} {date} {correlation:.4f} '
+            f'{"-" if outcome is None else f"{outcome.opened_side} {outcome.close_type} {outcome.revenue}"}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Similar historical sessions of bars as they arrive')
+    parser.add_argument('--sma-window', type=int, default=3)
+    parser.add_argument('--type-vol', type=float, default=0.25)
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument('--coordinates-basis', default='close')
+    parser.add_argument('--stop-loss', type=float, default=0.5)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--stocks', nargs='*', default=None, help='match sessions of these stocks only')
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help='replay a day of source_data through a queue')
+    replay_parser.add_argument('stock_name')
+    replay_parser.add_argument('date', help='first replayed day, history ends the day before')
+    replay_parser.add_argument('--days', type=int, default=1)
+    replay_parser.add_argument('--interval', type=float, default=0.0, help='seconds between bars')
+    tail_parser = commands.add_parser('tail', help='follow bars appended to a source_data file')
+    tail_parser.add_argument('stock_name')
+    tail_parser.add_argument('--poll-interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    sd_folder_path = generate_file_path('source_data')
+    configs = [BaseConfig().builder()
+               .with_file_path(os.path.join(sd_folder_path, f))
+               .with_sma_window(args.sma_window)
+               .with_type_vol(args.type_vol)
+               .with_depth(args.depth)
+               .with_coordinates_basis(args.coordinates_basis)
+               .with_stop_loss(args.stop_loss)
+               .build() for f in sorted(os.listdir(sd_folder_path))]
+    live_config = next(c for c in configs if get_stock_name(c.file_path) == args.stock_name)
+    store = DataProviderService(live_config).read_5min_data().bar_store
+
+    if args.command == 'replay':
+        first_day = np.datetime64(args.date, 'D')
+        history_end = str(first_day - 1)
+        before = store.date_time < first_day
+        replayed = store.slice(int(before.sum()), int((store.date_time < first_day + args.days).sum()))
+    else:
+        history_end = None
+        before = np.ones(len(store), dtype=bool)
+
+    session = LiveSession(live_config, SessionHistory.build(configs, history_end), args.k, args.stocks,
+                          store.price_open[before])
+    log(f'History of {len(session.history.index)} sessions loaded')
+
+    async def main():
+        if args.command == 'replay':
+            queue = asyncio.Queue()
+            await asyncio.gather(replay(replayed.bars(), queue, args.interval),
+                                 session.run(QueueSource(queue), _print_match))
+        else:
+            await session.run(CsvTailSource(live_config.file_path, args.poll_interval), _print_match)
+
+    asyncio.run(main())
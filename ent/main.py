@@ -1,20 +1,200 @@
+import argparse
+import copy
 import datetime
 import os
-from concurrent.futures import ProcessPoolExecutor
+import traceback
+from collections import Counter
+from functools import partial
+from typing import Dict, List, Optional, Tuple
 
-from ent.base_ds import BaseConfig
-from ent.job import GroupByCorrelationPerStockJob
-from ent.utils import generate_file_path
+from ent.base_ds import BaseConfig, SweepConfig, JobResult, BacktestObject
+from ent.cache import BarCache
+from ent.job import GroupByCorrelationPerStockJob, IncrementalGroupByCorrelationJob, ParameterSweepJob, \
+    CrossStockGroupByCorrelationJob
+from ent.metrics import metrics
+from ent.pipeline import Pipeline
+from ent.profiling import Profiling
+from ent.repository import Repository, ResultWriter
+from ent.scheduler import JobScheduler, Task
+from ent.shared_bars import SharedBarRegistry, load_shared_bars
+from ent.utils import generate_file_path, to_range, get_stock_name, log
 
 
-# TODO Add sma_window, type_vol, depth, coordinates_basis. Add dependency management. Split by packages.
+# TODO Add dependency management. Split by packages.
 
-def execute_job(config):
+orchestrators = ('pipeline', 'per-ticker')
+
+
+def _compute_job(job, file_path: str) -> JobResult:
+    stock_name = os.path.basename(file_path)
+    try:
+        stock_name = get_stock_name(file_path)
+        with Profiling.profiled(stock_name):
+            df = job.compute()
+        return JobResult(stock_name, job.target_db_table_name, df.to_records(index=False), metrics=metrics.drain(),
+                         on_written=job.on_written)
+    except Exception:
+        return JobResult(stock_name, job.target_db_table_name, error=traceback.format_exc(), metrics=metrics.drain())
+
+
+def execute_job(config) -> JobResult:
+    return _compute_job(GroupByCorrelationPerStockJob(config), config.file_path)
+
+
+def execute_incremental_job(config, state_dir: str = None) -> JobResult:
+    return _compute_job(IncrementalGroupByCorrelationJob(config, state_dir), config.file_path)
+
+
+def execute_sweep_job(sweep) -> JobResult:
+    return _compute_job(ParameterSweepJob(sweep), sweep.file_path)
+
+
+def execute_backtest_chunk(config, date_from, date_to) -> Tuple[Dict[str, BacktestObject], Optional[List[dict]]]:
+    with Profiling.profiled(f'{get_stock_name(config.file_path)}-{date_from}-{date_to}'):
+        backtest = GroupByCorrelationPerStockJob(config).backtest(date_from, date_to)
+    return backtest, metrics.drain()
+
+
+def execute_group(config, chunks: List[Dict[str, BacktestObject]]) -> JobResult:
+    merged = {trading_date: backtest for chunk in chunks for trading_date, backtest in chunk.items()}
     job = GroupByCorrelationPerStockJob(config)
-    job.execute()
+    stock_name = get_stock_name(config.file_path)
+    with Profiling.profiled(f'{stock_name}-group'):
+        df = job.group(merged, stock_name)
+    return JobResult(stock_name, job.target_db_table_name, df.to_records(index=False), metrics=metrics.drain())
+
+
+def _inputs(config: BaseConfig) -> List[str]:
+    cached = BarCache(config.cache_dir).entry_paths(config.file_path) if config.use_cache else []
+    return cached if cached else [config.file_path]
+
+
+def _shared_task(function, jobs: List[Tuple[BaseConfig, str]], bars: int, registry: SharedBarRegistry) -> Task:
+    """
+        Several jobs on a file, given with the keys of their results: when their turn comes a worker loads
+        the bars once into shared memory, then the jobs run attached to it. Each releases its reference
+        when it's done, so the segment goes with the last of them (or at the end of the run if one fails).
+        A failed load is reported for every job.
+    """
+    config = jobs[0][0]
+    name = os.path.basename(config.file_path)
+
+    def loaded(handle):
+        shared = registry.adopt(handle, len(jobs))
+        tasks = []
+        for job_config, key in jobs:
+            shared_config = copy.copy(job_config)
+            shared_config.shared_bars = shared
+            tasks.append(Task(bars, function, (shared_config,), name, lambda _: registry.release(shared), key=key))
+        return tasks
+
+    return Task(bars * len(jobs), load_shared_bars, (config,), name, loaded, inputs=_inputs(config),
+                key=tuple(key for _, key in jobs))
+
+
+def _chunked_task(scheduler: JobScheduler, config, bars: int, parts: int, registry: SharedBarRegistry,
+                  key: str) -> Task:
+    """
+        Per-day stages of a large ticker run as chunks of consecutive days with about the same number
+        of bars; once all of them are done their results are merged and grouped in one task.
+        When the ticker's turn comes a worker streams its bars into shared memory, chunk by chunk, then
+        the chunks are dispatched and every one maps only its own days (and the opens before them),
+        so neither the load nor a chunk grows with the file.
+        The segment is released when the ticker is grouped (or at the end of the run if a chunk fails).
+        The grouping runs on all days of the ticker: it isn't split, nor sized by the worker memory cap.
+    """
+    name = os.path.basename(config.file_path)
+    chunks = [None] * parts
+    remaining = [parts]
+
+    def loaded(handle):
+        shared = registry.adopt(handle)
+        dates, offsets = shared.days
+        ranges = scheduler.split_days(offsets, parts)
+        del chunks[len(ranges):]
+        remaining[0] = len(ranges)
+
+        def collect(k):
+            def then(result):
+                chunks[k], records = result
+                metrics.extend(records)
+                remaining[0] -= 1
+                return [Task(shared.length, execute_group, (config, chunks), name,
+                             lambda _: registry.release(shared), key=key)] if remaining[0] == 0 else []
+            return then
+
+        tasks = []
+        for k, (first, last) in enumerate(ranges):
+            chunk_config = copy.copy(config)
+            chunk_config.shared_bars = shared.rows(int(offsets[first]), int(offsets[last]))
+            date_from, date_to = (dates[first], dates[last - 1]) if last > first else (None, None)
+            tasks.append(Task(int(offsets[last] - offsets[first]), execute_backtest_chunk,
+                              (chunk_config, date_from, date_to), f'{name}[{k}]', collect(k), key=key))
+        return tasks
+
+    return Task(bars, load_shared_bars, (config, scheduler.chunk_bars), name, loaded, inputs=_inputs(config),
+                key=key)
+
+
+def _add_result(writer: ResultWriter, task: Task, future) -> None:
+    if future.exception() is not None:
+        error = ''.join(traceback.format_exception(future.exception()))
+        for key in task.key if isinstance(task.key, tuple) else (task.key,):
+            writer.add(JobResult(task.name, None, error=error), key)
+    elif isinstance(future.result(), JobResult):
+        metrics.extend(future.result().metrics)
+        writer.add(future.result(), task.key)
 
 
-def start_jobs():
+def run_jobs(function, configs: list, scheduler: JobScheduler = None, chunked: bool = False,
+             orchestrator: str = 'pipeline') -> ResultWriter:
+    """
+        Runs jobs in a process pool, largest first; their results are written by a single writer
+        in this process, as they complete. With `chunked` large tickers are split into chunks of days.
+        The bars of a file used by several jobs are loaded once into shared memory.
+
+        orchestrator='pipeline' overlaps input prefetch and result writes with the pool (see Pipeline),
+        orchestrator='per-ticker' reads in the workers and writes in the scheduler loop, in batches.
+    """
+    if orchestrator not in orchestrators:
+        raise ValueError(f'Unknown orchestrator: {orchestrator}, expected one of {orchestrators}')
+    scheduler = scheduler if scheduler else JobScheduler()
+    writer = ResultWriter(Repository('iamdefault', '12345', 'logos'))
+
+    jobs_of_file = Counter(c.file_path for c in configs)
+    seen = Counter()
+    with SharedBarRegistry() as registry:
+        tasks = []
+        shared_jobs: Dict[str, List[Tuple[BaseConfig, str]]] = {}
+        for c in configs:
+            config = c if isinstance(c, BaseConfig) else c.configs()[0]
+            # Results are reported by file, and by job within a file used by several of them
+            key = c.file_path if jobs_of_file[c.file_path] == 1 else f'{c.file_path}[{seen[c.file_path]}]'
+            seen[c.file_path] += 1
+            bars = scheduler.estimate_bars(config)
+            parts = scheduler.chunks_count(bars) if chunked else 1
+            if parts > 1:
+                tasks.append(_chunked_task(scheduler, c, bars, parts, registry, key))
+            elif isinstance(c, BaseConfig) and jobs_of_file[c.file_path] > 1:
+                shared_jobs.setdefault(c.file_path, []).append((c, key))
+            else:
+                tasks.append(Task(bars, function, (c,), os.path.basename(c.file_path), inputs=_inputs(config),
+                                  key=key))
+        tasks.extend(_shared_task(function, jobs, scheduler.estimate_bars(jobs[0][0]), registry)
+                     for jobs in shared_jobs.values())
+
+        if orchestrator == 'pipeline':
+            Pipeline(scheduler).run(tasks, partial(_add_result, writer), writer.flush)
+        else:
+            for task, future in scheduler.run(tasks):
+                _add_result(writer, task, future)
+
+    writer.flush()
+    log(writer.report())
+    return writer
+
+
+def _configs(sma_window, type_vol, depth, coordinates_basis, stop_loss, read_chunk_rows=None) -> List[BaseConfig]:
     job_configs = []
     sd_folder_path = generate_file_path('source_data')
     files = os.listdir(sd_folder_path)
@@ -22,23 +202,139 @@ def start_jobs():
         file_path = os.path.join(sd_folder_path, f)
         c = BaseConfig().builder() \
             .with_file_path(file_path) \
-            .with_sma_window(3) \
-            .with_type_vol(0.25) \
-            .with_depth(20) \
-            .with_coordinates_basis('close') \
-            .with_stop_loss(0.5) \
+            .with_sma_window(sma_window) \
+            .with_type_vol(type_vol) \
+            .with_depth(depth) \
+            .with_coordinates_basis(coordinates_basis) \
+            .with_stop_loss(stop_loss) \
+            .with_read_chunk_rows(read_chunk_rows) \
             .build()
         job_configs.append(c)
+    return job_configs
+
+
+def start_jobs(sma_window=3, type_vol=0.25, depth=20, coordinates_basis='close', stop_loss=0.5,
+               scheduler: JobScheduler = None, incremental: bool = False, state_dir: str = None,
+               read_chunk_rows: int = None, orchestrator: str = 'pipeline'):
+    """
+        With `incremental` only trading days that are new since the previous incremental run are processed.
+        With `read_chunk_rows` files are streamed in chunks of about that many bars.
+    """
+    job_configs = _configs(sma_window, type_vol, depth, coordinates_basis, stop_loss, read_chunk_rows)
+
+    if incremental:
+        return run_jobs(partial(execute_incremental_job, state_dir=state_dir), job_configs, scheduler,
+                        orchestrator=orchestrator)
+    return run_jobs(execute_job, job_configs, scheduler, chunked=True, orchestrator=orchestrator)
+
+
+def start_cross_stock(sma_window=3, type_vol=0.25, depth=20, coordinates_basis='close', stop_loss=0.5,
+                      scheduler: JobScheduler = None, block_size: int = 2048,
+                      read_chunk_rows: int = None) -> ResultWriter:
+    job = CrossStockGroupByCorrelationJob(
+        _configs(sma_window, type_vol, depth, coordinates_basis, stop_loss, read_chunk_rows), scheduler, block_size)
+    writer = ResultWriter(Repository('iamdefault', '12345', 'logos'))
+    try:
+        writer.add(JobResult('cross_stock', job.target_db_table_name, job.compute().to_records(index=False)))
+    except Exception:
+        writer.add(JobResult('cross_stock', job.target_db_table_name, error=traceback.format_exc()))
+
+    writer.flush()
+    log(writer.report())
+    return writer
+
 
-    with ProcessPoolExecutor() as executor:
-        executor.map(execute_job, job_configs)
+def start_sweep(sma_windows: List[int],
+                type_vols: List[float],
+                depths: List[int],
+                coordinates_bases: List[str],
+                stop_losses: List[float],
+                scheduler: JobScheduler = None,
+                orchestrator: str = 'pipeline'):
+    sweeps = []
+    sd_folder_path = generate_file_path('source_data')
+    files = os.listdir(sd_folder_path)
+    for f in files:
+        file_path = os.path.join(sd_folder_path, f)
+        s = SweepConfig().builder() \
+            .with_file_path(file_path) \
+            .with_sma_windows(sma_windows) \
+            .with_type_vols(type_vols) \
+            .with_depths(depths) \
+            .with_coordinates_bases(coordinates_bases) \
+            .with_stop_losses(stop_losses) \
+            .build()
+        sweeps.append(s)
+
+    return run_jobs(execute_sweep_job, sweeps, scheduler, orchestrator=orchestrator)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Group trading days by grid correlation for every file in source_data')
+    ranges_help = 'one or more values or start:stop:step ranges; several values run a parameter sweep'
+    parser.add_argument('--sma-window', nargs='+', default=['3'], help=ranges_help)
+    parser.add_argument('--type-vol', nargs='+', default=['0.25'], help=ranges_help)
+    parser.add_argument('--depth', nargs='+', default=['20'], help=ranges_help)
+    parser.add_argument('--coordinates-basis', nargs='+', default=['close'])
+    parser.add_argument('--stop-loss', nargs='+', default=['0.5'], help=ranges_help)
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--max-worker-memory-mb', type=int, default=None,
+                        help='address space cap per worker; the per-day stages of larger tickers are split '
+                             'by days, their final grouping is not')
+    parser.add_argument('--chunk-bars', type=int, default=None, help='split tickers with more bars than this')
+    parser.add_argument('--incremental', action='store_true',
+                        help='process only trading days that are new since the previous incremental run')
+    parser.add_argument('--state-dir', default=None, help='state of incremental runs (default: state)')
+    parser.add_argument('--cross-stock', action='store_true', help='group trading days of all stocks together')
+    parser.add_argument('--block-size', type=int, default=2048, help='rows per correlation tile in cross-stock mode')
+    parser.add_argument('--read-chunk-rows', type=int, default=None,
+                        help='stream files in chunks of about this many bars instead of loading them at once')
+    parser.add_argument('--orchestrator', choices=orchestrators, default='pipeline',
+                        help='pipeline: prefetch, compute and writes overlap; per-ticker: the previous scheduler loop')
+    parser.add_argument('--metrics-jsonl', default=None, help='append per-stage metrics records to this file')
+    parser.add_argument('--metrics-prom', default=None, help='write per-stage metrics in Prometheus text format')
+    parser.add_argument('--profile', choices=Profiling.modes, default=None,
+                        help='profile every job with cProfile or the sampling profiler, merged at the end')
+    parser.add_argument('--profile-dir', default=None,
+                        help='per-job and merged profiles, in a subdirectory per run (default: profiles)')
+    args = parser.parse_args()
+
+    args.sma_window = [v for value in args.sma_window for v in to_range(value, int)]
+    args.type_vol = [v for value in args.type_vol for v in to_range(value)]
+    args.depth = [v for value in args.depth for v in to_range(value, int)]
+    args.stop_loss = [v for value in args.stop_loss for v in to_range(value)]
+    return args
 
 
 if __name__ == '__main__':
+    args = parse_args()
+
+    if args.metrics_jsonl or args.metrics_prom:
+        metrics.enable()
+    if args.profile:
+        Profiling.enable(args.profile, args.profile_dir)
+
     start = datetime.datetime.now()
     print(start)
 
-    start_jobs()
+    scheduler = JobScheduler(args.max_workers, args.max_worker_memory_mb, args.chunk_bars)
+    if max(len(args.sma_window), len(args.type_vol), len(args.depth), len(args.coordinates_basis),
+           len(args.stop_loss)) > 1:
+        start_sweep(args.sma_window, args.type_vol, args.depth, args.coordinates_basis, args.stop_loss, scheduler,
+                    args.orchestrator)
+    elif args.cross_stock:
+        start_cross_stock(args.sma_window[0], args.type_vol[0], args.depth[0], args.coordinates_basis[0],
+                          args.stop_loss[0], scheduler, args.block_size, args.read_chunk_rows)
+    else:
+        start_jobs(args.sma_window[0], args.type_vol[0], args.depth[0], args.coordinates_basis[0], args.stop_loss[0],
+                   scheduler, args.incremental, args.state_dir, args.read_chunk_rows, args.orchestrator)
     end = datetime.datetime.now()
 
-    print((start - end).total_seconds())
+    print((end - start).total_seconds())
+
+    if args.metrics_jsonl:
+        metrics.write_jsonl(args.metrics_jsonl)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+    if args.profile:
+        log(f'Merged profiles: {", ".join(Profiling.merge()) or "none"}')
@@ -0,0 +1,176 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+
+class _DisabledStage:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_DISABLED_STAGE = _DisabledStage()
+
+
+def _read_peak_rss() -> int:
+    # VmHWM of the process in bytes, resettable through clear_refs; lifetime peak where /proc isn't available
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss() -> None:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class Stage:
+    """
+        Timed block of a job stage. Set `rows` inside the block to record the rows it produced.
+    """
+
+    __slots__ = ('metrics', 'name', 'ticker', 'rows', 'wall', 'cpu', 'peak_rss')
+
+    def __init__(self, metrics: 'Metrics', name: str, ticker: str = None, rows: int = None):
+        self.metrics = metrics
+        self.name = name
+        self.ticker = ticker
+        self.rows = rows
+        self.peak_rss = 0
+
+    def __enter__(self):
+        stack = self.metrics.stack
+        if stack:
+            # The reset below drops what the enclosing stage has peaked at so far
+            stack[-1].peak_rss = max(stack[-1].peak_rss, _read_peak_rss())
+        _reset_peak_rss()
+        stack.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stack = self.metrics.stack
+        stack.pop()
+        self.peak_rss = max(self.peak_rss, _read_peak_rss())
+        if stack:
+            stack[-1].peak_rss = max(stack[-1].peak_rss, self.peak_rss)
+
+        self.metrics.records.append({
+            'ticker': self.ticker,
+            'stage': self.name,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'peak_rss_bytes': self.peak_rss,
+            'rows': self.rows,
+            'ok': exc_type is None,
+            'pid': os.getpid(),
+            'ts': time.time(),
+        })
+        return False
+
+
+class Metrics:
+    """
+        Per-stage wall time, CPU time, peak RSS and row counts of jobs.
+
+        Disabled by default, then stage() returns a shared no-op context manager, so instrumented
+        code only pays for one method call. Enabled with enable() or ENT_METRICS=1 in the environment
+        (which enable() also sets, so spawned workers record too). Workers send their records
+        to the parent with JobResult.metrics.
+        Example -> with metrics.stage('read', 'ABC') as stage: ... stage.rows = len(store)
+    """
+
+    env_variable = 'ENT_METRICS'
+
+    def __init__(self):
+        self.enabled = os.environ.get(self.env_variable) == '1'
+        self.records: List[dict] = []
+        self.stack: List[Stage] = []
+
+    def enable(self) -> None:
+        self.enabled = True
+        os.environ[self.env_variable] = '1'
+
+    def disable(self) -> None:
+        self.enabled = False
+        os.environ.pop(self.env_variable, None)
+
+    def stage(self, name: str, ticker: str = None, rows: int = None):
+        if not self.enabled:
+            return _DISABLED_STAGE
+        return Stage(self, name, ticker, rows)
+
+    def drain(self) -> Optional[List[dict]]:
+        """
+            Recorded records, cleared (None when disabled).
+        """
+        if not self.enabled:
+            return None
+        records, self.records = self.records, []
+        return records
+
+    def extend(self, records: Optional[List[dict]]) -> None:
+        if records:
+            self.records.extend(records)
+
+    def write_jsonl(self, path: str) -> None:
+        with open(path, 'a') as f:
+            f.writelines(json.dumps(record) + '\n' for record in self.records)
+
+    def aggregate(self) -> Dict[tuple, dict]:
+        """
+            Records summed by (ticker, stage), peak RSS as max.
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault((record['ticker'], record['stage']),
+                                      {'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_bytes': 0, 'rows': 0, 'count': 0})
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'], record['peak_rss_bytes'])
+            total['rows'] += record['rows'] or 0
+            total['count'] += 1
+        return totals
+
+    def write_prometheus(self, path: str) -> None:
+        """
+            Text exposition format, e.g. for the node exporter textfile collector (written atomically).
+        """
+        series = [('ent_stage_wall_seconds', 'wall_s', 'counter', 'Wall time of the stage'),
+                  ('ent_stage_cpu_seconds', 'cpu_s', 'counter', 'CPU time of the stage'),
+                  ('ent_stage_peak_rss_bytes', 'peak_rss_bytes', 'gauge', 'Peak resident memory during the stage'),
+                  ('ent_stage_rows', 'rows', 'counter', 'Rows produced by the stage'),
+                  ('ent_stage_runs', 'count', 'counter', 'Runs of the stage')]
+        totals = self.aggregate()
+
+        lines = []
+        for name, key, metric_type, help_text in series:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (ticker, stage), total in sorted(totals.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+                lines.append(f'{name}{{ticker="{ticker or ""}",stage="{stage}"}} {total[key]}')
+
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,116 @@
+import asyncio
+import heapq
+from itertools import count
+from typing import Callable, List
+
+from ent.scheduler import JobScheduler, Task
+
+
+def _warm(paths: List[str], block_size: int = 1 << 20) -> int:
+    # Reads the files through the page cache, so the worker's read of them doesn't wait on the disk
+    buffer = bytearray(block_size)
+    total = 0
+    for path in paths:
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    read = f.readinto(buffer)
+                    if not read:
+                        break
+                    total += read
+        except OSError:
+            pass
+    return total
+
+
+class Pipeline:
+    """
+        Asyncio orchestration of jobs in three stages connected by bounded queues, so disk reads
+        and database writes overlap the CPU-bound work instead of blocking it:
+
+            prefetch - the inputs of the next tasks are read ahead in a thread, at most `prefetch` tasks ahead
+            compute  - tasks run in the scheduler's process pool, `max_workers` at a time, largest first
+                       (follow-up tasks, e.g. the merge of a chunked ticker, go before new ones)
+            sink     - results are passed to `on_result` in a thread, in batches of the results waiting,
+                       and `flush` runs once at the end (a ResultWriter writes a table by itself
+                       once `batch_rows` of its rows are pending)
+
+        A full results queue stops submissions until the sink catches up.
+        Example -> Pipeline(JobScheduler()).run(tasks, on_result, writer.flush)
+    """
+
+    def __init__(self, scheduler: JobScheduler = None, prefetch: int = None, results: int = None):
+        self.scheduler = scheduler if scheduler else JobScheduler()
+        self.prefetch = prefetch if prefetch else self.scheduler.max_workers
+        self.results = results if results else 2 * self.scheduler.max_workers
+
+    def run(self, tasks: List[Task], on_result: Callable, flush: Callable = None) -> None:
+        asyncio.run(self._run(tasks, on_result, flush))
+
+    async def _run(self, tasks: List[Task], on_result: Callable, flush: Callable) -> None:
+        prefetched = asyncio.Queue(self.prefetch)
+        results = asyncio.Queue(self.results)
+        await asyncio.gather(self._prefetch(tasks, prefetched),
+                             self._compute(prefetched, results),
+                             self._sink(results, on_result, flush))
+
+    @staticmethod
+    async def _prefetch(tasks: List[Task], prefetched: asyncio.Queue) -> None:
+        for task in sorted(tasks, key=lambda t: -t.cost):
+            if task.inputs:
+                await asyncio.to_thread(_warm, task.inputs)
+            await prefetched.put(task)
+        await prefetched.put(None)
+
+    async def _compute(self, prefetched: asyncio.Queue, results: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        follow_ups = []
+        order = count()
+        running = {}
+        getter = None
+        more = True
+
+        with self.scheduler.executor() as executor:
+            while more or follow_ups or running:
+                while follow_ups and len(running) < self.scheduler.max_workers:
+                    _, _, task = heapq.heappop(follow_ups)
+                    running[loop.run_in_executor(executor, task.function, *task.args)] = task
+                # A new task is only taken from the prefetch queue for a free worker, so it stays bounded
+                if more and getter is None and len(running) < self.scheduler.max_workers:
+                    getter = asyncio.ensure_future(prefetched.get())
+
+                done, _ = await asyncio.wait(set(running) | ({getter} if getter else set()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    task, getter = getter.result(), None
+                    if task is None:
+                        more = False
+                    else:
+                        running[loop.run_in_executor(executor, task.function, *task.args)] = task
+
+                for future in done:
+                    task = running.pop(future, None)
+                    if task is None:
+                        continue
+                    if task.then is not None and future.exception() is None:
+                        for follow_up in task.then(future.result()) or []:
+                            heapq.heappush(follow_ups, (-follow_up.cost, next(order), follow_up))
+                    await results.put((task, future))
+        await results.put(None)
+
+    @staticmethod
+    async def _sink(results: asyncio.Queue, on_result: Callable, flush: Callable) -> None:
+        while True:
+            item = await results.get()
+            batch = [item]
+            while item is not None and not results.empty():
+                item = results.get_nowait()
+                batch.append(item)
+
+            completed = [result for result in batch if result is not None]
+            if completed:
+                await asyncio.to_thread(lambda: [on_result(task, future) for task, future in completed])
+            if batch[-1] is None:
+                if flush is not None:
+                    await asyncio.to_thread(flush)
+                return
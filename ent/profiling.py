@@ -0,0 +1,179 @@
+import argparse
+import cProfile
+import os
+import pstats
+import signal
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import count
+from typing import List, Optional
+
+from ent.utils import generate_file_path, log
+
+_runs = count()
+
+
+class SamplingProfiler:
+    """
+        Low-overhead statistical profiler: the stack of the main thread is sampled every
+        `interval` seconds of CPU time (SIGPROF) and counted as a collapsed stack,
+        the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.counts = Counter()
+        self._previous_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler)
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as f:
+            f.writelines(f'{stack} {samples}\n' for stack, samples in self.counts.items())
+
+
+class Profiling:
+    """
+        Opt-in profiling of job runs, set through the environment so that pool workers inherit it:
+            ENT_PROFILE=cprofile - cProfile, one <name>-<pid>-<run>.prof file per run
+            ENT_PROFILE=sample - SamplingProfiler, one .collapsed file per run (cProfile outside the main thread)
+            ENT_PROFILE_DIR - output directory (default: profiles)
+            ENT_PROFILE_RUN - subdirectory of the run, set by enable(), e.g. 20240105-093012-4242
+        merge() aggregates the files of all workers of the run into one report per kind.
+    """
+
+    mode_variable = 'ENT_PROFILE'
+    dir_variable = 'ENT_PROFILE_DIR'
+    run_variable = 'ENT_PROFILE_RUN'
+    modes = ('cprofile', 'sample')
+
+    @classmethod
+    def enable(cls, mode: str, profile_dir: str = None) -> None:
+        """
+            Profiles the following jobs of this process and of its workers into a new run directory,
+            so reports don't mix in profiles of earlier runs.
+        """
+        if mode not in cls.modes:
+            raise ValueError(f'Unknown profiling mode: {mode}, expected one of {cls.modes}')
+        os.environ[cls.mode_variable] = mode
+        if profile_dir:
+            os.environ[cls.dir_variable] = profile_dir
+        os.environ[cls.run_variable] = f'{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}'
+
+    @classmethod
+    def mode(cls) -> Optional[str]:
+        return os.environ.get(cls.mode_variable) or None
+
+    @classmethod
+    def profile_dir(cls) -> str:
+        return os.environ.get(cls.dir_variable) or generate_file_path('profiles')
+
+    @classmethod
+    def run_dir(cls) -> str:
+        """
+            Directory of the current run's profiles, or the latest run's when profiling isn't enabled.
+        """
+        run = os.environ.get(cls.run_variable)
+        if run:
+            return os.path.join(cls.profile_dir(), run)
+        base = cls.profile_dir()
+        runs = sorted(d for d in os.listdir(base) if os.path.isdir(os.path.join(base, d))) if os.path.isdir(base) else []
+        return os.path.join(base, runs[-1]) if runs else base
+
+    @classmethod
+    @contextmanager
+    def profiled(cls, name: str):
+        """
+            Profiles the block when profiling is enabled, otherwise does nothing.
+            Example -> with Profiling.profiled('ABC'): job.compute()
+        """
+        mode = cls.mode()
+        if mode is None:
+            yield
+            return
+
+        os.makedirs(cls.run_dir(), exist_ok=True)
+        path = os.path.join(cls.run_dir(), f'{name}-{os.getpid()}-{next(_runs)}')
+        # Signals are only delivered to the main thread
+        if mode == 'sample' and threading.current_thread() is threading.main_thread():
+            profiler = SamplingProfiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                profiler.write(f'{path}.collapsed')
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(f'{path}.prof')
+
+    @classmethod
+    def merge(cls, profile_dir: str = None, output: str = None) -> List[str]:
+        """
+            Aggregates the .prof files (pstats) and the .collapsed files (summed stacks) of a run directory
+            (the current or latest run by default) into merged.prof and merged.collapsed.
+            Returns the paths of the merged reports; `output` names the merged.prof one.
+        """
+        profile_dir = profile_dir if profile_dir else cls.run_dir()
+        if not os.path.isdir(profile_dir):
+            return []
+        names = sorted(f for f in os.listdir(profile_dir) if not f.startswith('merged.'))
+        prof_files = [os.path.join(profile_dir, f) for f in names if f.endswith('.prof')]
+        collapsed_files = [os.path.join(profile_dir, f) for f in names if f.endswith('.collapsed')]
+
+        merged = []
+        if prof_files:
+            path = output if output else os.path.join(profile_dir, 'merged.prof')
+            pstats.Stats(*prof_files).dump_stats(path)
+            merged.append(path)
+
+        if collapsed_files:
+            counts = Counter()
+            for path in collapsed_files:
+                with open(path) as f:
+                    for line in f:
+                        stack, _, samples = line.rstrip('\n').rpartition(' ')
+                        counts[stack] += int(samples)
+            path = os.path.join(profile_dir, 'merged.collapsed')
+            with open(path, 'w') as f:
+                f.writelines(f'{stack} {samples}\n' for stack, samples in counts.most_common())
+            merged.append(path)
+
+        return merged
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge per-job profiles into one report')
+    parser.add_argument('profile_dir', nargs='?', default=None, help='run directory (default: the latest run)')
+    parser.add_argument('--output', default=None, help='merged cProfile stats (default: <run>/merged.prof)')
+    parser.add_argument('--top', type=int, default=30, help='functions to print from merged cProfile stats')
+    args = parser.parse_args()
+
+    merged = Profiling.merge(args.profile_dir, args.output)
+    if not merged:
+        log('No profiles found')
+    for path in merged:
+        if path.endswith('.prof'):
+            pstats.Stats(path).sort_stats('cumulative').print_stats(args.top)
+        else:
+            log(f'Collapsed stacks written to {path}')
@@ -0,0 +1,127 @@
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, Future
+from itertools import count
+from typing import Callable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from ent.base_ds import BaseConfig
+from ent.cache import BarCache
+
+
+class Task:
+
+    def __init__(self, cost: int, function: Callable, args: tuple, name: str, then: Callable = None,
+                 inputs: List[str] = None, key: Union[str, Tuple[str, ...]] = None):
+        """
+            `then` is called in the parent with the task result and may return follow-up tasks.
+            `inputs` are the files the task reads, prefetched by the Pipeline.
+            `key` identifies the job the task belongs to in the results (default: `name`),
+            e.g. the file path shared by the chunks of a ticker, or the jobs it belongs to.
+        """
+        self.cost = cost
+        self.function = function
+        self.args = args
+        self.name = name
+        self.then = then
+        self.inputs = inputs if inputs is not None else []
+        self.key = key if key is not None else name
+
+    def __str__(self):
+        return f"Task(name={self.name}, cost={self.cost})"
+
+
+def _limit_worker_memory(max_bytes: int):
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+class JobScheduler:
+    """
+        Longest-processing-time-first scheduling of jobs over a process pool.
+
+        Only `max_workers` tasks are in flight at any time; whenever one finishes, the most
+        expensive ready task is submitted next, including follow-up tasks (e.g. the merge of
+        a chunked ticker), so no core is left with a big task at the end of the batch.
+        With `max_worker_memory_mb` every worker's address space is capped (RLIMIT_AS),
+        and the per-day stages of tickers estimated above the cap are split into chunks of days.
+        The grouping of a chunked ticker runs on all its days at once and isn't sized by the cap.
+    """
+
+    # Rough peak memory per bar through read, frame, grids and strategy stages
+    bytes_per_bar = 400
+    sample_size = 1 << 16
+
+    def __init__(self, max_workers: int = None, max_worker_memory_mb: int = None, chunk_bars: int = None):
+        self.max_workers = max_workers if max_workers else os.cpu_count()
+        self.max_worker_memory_mb = max_worker_memory_mb
+        if chunk_bars is None and max_worker_memory_mb is not None:
+            chunk_bars = max_worker_memory_mb * (1 << 20) // 2 // self.bytes_per_bar
+        self.chunk_bars = chunk_bars
+
+    @staticmethod
+    def estimate_bars(config: BaseConfig) -> int:
+        """
+            Bars count of the cached, session-filtered data if available,
+            otherwise the rows count estimated from the file size.
+        """
+        meta = BarCache(config.cache_dir).get_meta(config.file_path) if config.use_cache else None
+        if meta is not None and meta['size'] == os.path.getsize(config.file_path):
+            return meta['bars']
+
+        with open(config.file_path, 'rb') as f:
+            sample = f.read(JobScheduler.sample_size)
+        rows = max(sample.count(b'\n'), 1)
+        return int(os.path.getsize(config.file_path) * rows / max(len(sample), 1))
+
+    @staticmethod
+    def split_days(offsets: np.ndarray, parts: int) -> List[Tuple[int, int]]:
+        """
+            Consecutive, non-overlapping [first, last) ranges of whole days with about the same number
+            of bars, from the day offsets of a BarStore (see BarStore.days()).
+            Example -> offsets [0, 79, 158, 237], 2 parts -> [(0, 2), (2, 3)]
+        """
+        days = len(offsets) - 1
+        bounds = np.searchsorted(offsets, np.arange(1, parts) * offsets[-1] / parts)
+        bounds = np.unique(np.concatenate(([0], bounds, [days]))) if days > 0 else np.array([0, 0])
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def chunks_count(self, bars: int) -> int:
+        if not self.chunk_bars or bars <= self.chunk_bars:
+            return 1
+        return -(-bars // self.chunk_bars)
+
+    def executor(self) -> ProcessPoolExecutor:
+        initializer, initargs = (None, ())
+        if self.max_worker_memory_mb:
+            initializer, initargs = _limit_worker_memory, (self.max_worker_memory_mb * (1 << 20),)
+        return ProcessPoolExecutor(self.max_workers, initializer=initializer, initargs=initargs)
+
+    def run(self, tasks: List[Task]) -> Iterator[Tuple[Task, Future]]:
+        """
+            Yields every task (including follow-ups) with its completed future.
+        """
+        ready = []
+        order = count()
+
+        def push(task: Task):
+            heapq.heappush(ready, (-task.cost, next(order), task))
+
+        for task in tasks:
+            push(task)
+
+        with self.executor() as executor:
+            running = {}
+            while ready or running:
+                while ready and len(running) < self.max_workers:
+                    _, _, task = heapq.heappop(ready)
+                    running[executor.submit(task.function, *task.args)] = task
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if task.then is not None and future.exception() is None:
+                        for follow_up in task.then(future.result()) or []:
+                            push(follow_up)
+                    yield task, future
@@ -1,21 +1,18 @@
-import csv
 import pandas as pd
 import numpy as np
+from bisect import bisect_left, bisect_right
 
-from typing import List, Dict
-from itertools import combinations
+from typing import List, Dict, Iterable, Iterator, Tuple
 
+from ent.cache import BarCache
+from ent.correlation import CorrelationEngine
 from ent.trading_strategy import Strategy
 from ent.utils import log, get_stock_name
-from ent.base_ds import TradingDay, BaseConfig
-from ent.visualizers import qf_visualize
+from ent.base_ds import TradingDay, BaseConfig, TestResults
 from datetime import time
 
-from ent.base_ds import Bar
+from ent.base_ds import Bar, BarStore
 from ent.base_mapper import BarMapper
-from utils import to_datetime
-
-from sklearn.cluster import DBSCAN
 
 
 class VisualizingService:
@@ -24,9 +21,22 @@ class VisualizingService:
         self.sessions = sessions
 
     def visualise_days(self, days_dates_list: List[str]):
+        # Plotting libraries are only imported on the plotting paths, pool workers never load them
+        from ent.visualizers import qf_visualize
+
         for day in days_dates_list:
             qf_visualize(self.sessions[day])
 
+    def export_groups(self, groups: Dict[str, List[str]], output_dir: str, max_workers: int = None) -> List[str]:
+        """
+                Batch export of charts of grouped days, a directory per group.
+                Example -> key:'2 34 66', value: ['2022-03-30', '2022-05-11', ...]
+            """
+        from ent.visualizers import export_charts
+
+        return export_charts({group: [self.sessions[day] for day in days if day in self.sessions]
+                              for group, days in groups.items()}, output_dir, max_workers)
+
 
 class StrategyService:
 
@@ -36,6 +46,9 @@ class StrategyService:
     def test_strategy(self, trading_day: TradingDay):
         return self.strategy.get_results(trading_day)
 
+    def test_strategy_by_days(self, trading_days: Dict[str, TradingDay]) -> Dict[str, TestResults]:
+        return dict(zip(trading_days.keys(), self.strategy.get_results_batch(list(trading_days.values()))))
+
 
 class TradingDayService:
 
@@ -68,40 +81,143 @@ class TradingDayService:
 
         return days
 
+    @staticmethod
+    def group_store_by_days(store: BarStore, stock_name: str) -> Dict[str, TradingDay]:
+        """
+                Same as group_bars_by_days, but every TradingDay
+                is a zero-copy slice of the columnar store.
+            """
+
+        days = {}
+        dates, offsets = store.days()
+        for key, start, end in zip(dates, offsets[:-1].tolist(), offsets[1:].tolist()):
+            if end - start == 79:
+                days[key] = TradingDay.from_store(store.slice(start, end), stock_name)
+
+        return days
+
 
 class DataProviderService:
     mapper = BarMapper()
     start_time = time(9, 29)
     end_time = time(16, 1)
-    five_min_bars = None
+    bar_store: BarStore = None
+    # Opens preceding bar_store in the file, for the sma of a streamed chunk
+    preceding_open: np.ndarray = None
 
     def __init__(self, config: BaseConfig):
         self.config = config
 
+    @property
+    def five_min_bars(self) -> List[Bar]:
+        return self.bar_store.bars() if self.bar_store is not None else None
+
     def read_5min_data(self):
-        self.five_min_bars: List[Bar] = []
-        with open(self.config.file_path, 'r', newline='') as csvfile:
-            csv_reader = csv.reader(csvfile)
-            next(csv_reader)
-
-            for row in csv_reader:
-                if self.start_time < to_datetime(row[0]).time() < self.end_time:
-                    bar = self.mapper.list_to_bar(row)
-                    if bar is not None:
-                        self.five_min_bars.append(bar)
+        if self.config.shared_bars is not None:
+            # The opens before a handle's first row continue the sma, as in stream_5min_data()
+            shared = self.config.shared_bars
+            lead = min(shared.start, max((self.config.sma_window or 1) - 1, 0))
+            store = shared.attach(lead)
+            self.bar_store = store.slice(lead, len(store)) if lead else store
+            self.preceding_open = store.price_open[:lead] if lead else None
+            return self
+
+        cache = BarCache(self.config.cache_dir) if self.config.use_cache else None
+        self.bar_store = cache.load(self.config.file_path, self.start_time, self.end_time) if cache else None
+
+        if self.bar_store is None:
+            self.bar_store = self.mapper.csv_to_bar_store(self.config.file_path, self.start_time, self.end_time)
+            if cache:
+                cache.save(self.config.file_path, self.start_time, self.end_time, self.bar_store)
         return self
 
-    def get_pandas_df(self) -> pd.DataFrame:
-        df = BarMapper().bars_list_to_pandas_df_with_parsed_dates(self.five_min_bars)
-        df['sma'] = df['open'].rolling(window=self.config.sma_window).mean()
+    def stream_5min_data(self, chunk_rows: int) -> Iterator['DataProviderService']:
+        """
+                Bars in chunks of complete trading days of about `chunk_rows` bars, one provider per chunk,
+                for files larger than memory. A fresh bars cache is sliced (its columns are memory-mapped),
+                otherwise the CSV is parsed chunk by chunk and not cached. Shared bars are mapped chunk by chunk.
+                The sma of get_pandas_df() continues over chunk boundaries; it's computed from the last
+                sma_window - 1 opens of the previous chunk rather than the whole history,
+                so it can differ from the in-memory one by float rounding.
+            """
+        if self.config.shared_bars is not None:
+            stores = self.config.shared_bars.chunks(chunk_rows)
+        else:
+            cache = BarCache(self.config.cache_dir) if self.config.use_cache else None
+            store = cache.load(self.config.file_path, self.start_time, self.end_time) if cache else None
+            stores = self._slice_by_days(store, chunk_rows) if store is not None else \
+                self.mapper.csv_to_bar_stores(self.config.file_path, self.start_time, self.end_time, chunk_rows)
+
+        preceding_open = None
+        for store in stores:
+            chunk = DataProviderService(self.config)
+            chunk.bar_store = store
+            chunk.preceding_open = preceding_open
+            yield chunk
+            preceding_open = store.price_open[len(store) - max((self.config.sma_window or 1) - 1, 0):].copy()
+
+    def max_5min_bars(self) -> int:
+        """
+            Upper bound of the bars read_5min_data() returns: their count if they're cached,
+            otherwise the lines of the file.
+        """
+        cache = BarCache(self.config.cache_dir) if self.config.use_cache else None
+        store = cache.load(self.config.file_path, self.start_time, self.end_time) if cache else None
+        if store is not None:
+            return len(store)
+        with open(self.config.file_path, 'rb') as f:
+            return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b'')) + 1
+
+    @staticmethod
+    def _slice_by_days(store: BarStore, chunk_rows: int) -> Iterator[BarStore]:
+        _, offsets = store.days()
+        start = 0
+        for end in offsets[1:].tolist():
+            if end - start >= chunk_rows or end == len(store):
+                yield store.slice(start, end)
+                start = end
+
+    def between(self, date_from: str = None, date_to: str = None) -> 'DataProviderService':
+        """
+            Provider of the trading days within [date_from, date_to] only: a zero-copy slice of the bars,
+            with the preceding opens the sma of get_pandas_df() continues from (see stream_5min_data()).
+            Bars that aren't ordered by day are kept whole.
+        """
+        dates, offsets = self.bar_store.days()
+        if any(a >= b for a, b in zip(dates, dates[1:])):
+            return self
+        start = int(offsets[bisect_left(dates, date_from)]) if date_from else 0
+        end = int(offsets[bisect_right(dates, date_to)]) if date_to else len(self.bar_store)
+
+        lead = max((self.config.sma_window or 1) - 1, 0)
+        if start < lead and self.preceding_open is not None:
+            opens = np.concatenate([self.preceding_open, self.bar_store.price_open[:start]])
+        else:
+            opens = self.bar_store.price_open[max(start - lead, 0):start]
+
+        chunk = DataProviderService(self.config)
+        chunk.bar_store = self.bar_store.slice(start, end)
+        chunk.preceding_open = opens[len(opens) - lead:] if lead else None
+        return chunk
+
+    def get_pandas_df(self, sma_window: int = None) -> pd.DataFrame:
+        df = BarMapper().bar_store_to_pandas_df(self.bar_store)
+        window = sma_window if sma_window else self.config.sma_window
+        if self.preceding_open is not None and len(self.preceding_open):
+            opens = pd.Series(np.concatenate([self.preceding_open, self.bar_store.price_open]))
+            df['sma'] = opens.rolling(window=window).mean().to_numpy()[len(self.preceding_open):]
+        else:
+            df['sma'] = df['open'].rolling(window=window).mean()
         return df
 
     def get_data_as_trading_days(self) -> Dict[str, TradingDay]:
         stock_name = get_stock_name(self.config.file_path)
-        return TradingDayService().group_bars_by_days(self.five_min_bars, stock_name)
+        return TradingDayService().group_store_by_days(self.bar_store, stock_name)
 
 
 class GridService:
+    # Slot of the depth window without a coordinate (NaN basis or a day shorter than depth)
+    MISSING = np.iinfo(np.uint16).max
 
     def __init__(self, type_vol, depth, coordinates_basis, data: pd.DataFrame):
         self.type_vol = type_vol
@@ -109,11 +225,41 @@ class GridService:
         self.coordinates_basis = coordinates_basis
         self.data = data
 
-    def _get_label(self, index):
+    @staticmethod
+    def _get_label(index):
         if index < 26:
             return chr(65 + index)
         else:
-            return self._get_label(index // 26 - 1) + self._get_label(index % 26)
+            return GridService._get_label(index // 26 - 1) + GridService._get_label(index % 26)
+
+    @staticmethod
+    def _labels(size: int) -> List[str]:
+        # Lookup table of labels by position, grown when a position goes past it
+        if len(_LABELS) < size:
+            _LABELS.extend(GridService._get_label(i) for i in range(len(_LABELS), max(size, 2 * len(_LABELS))))
+        return _LABELS
+
+    @staticmethod
+    def _parse_label(label: str) -> int:
+        index = 0
+        for c in label:
+            index = index * 26 + ord(c) - ord('A') + 1
+        return index - 1
+
+    @staticmethod
+    def to_string(positions: np.ndarray) -> str:
+        """
+                Renders a positions row as the 'A1-B2-...' grid string.
+            """
+        if isinstance(positions, str):
+            return positions
+        labels = GridService._labels(int(positions.max(where=positions != GridService.MISSING, initial=0)) + 1)
+        return '-'.join(f"{labels[position]}{i + 1}"
+                        for i, position in enumerate(positions.tolist()) if position != GridService.MISSING)
+
+    @staticmethod
+    def to_numerical(positions: np.ndarray) -> np.ndarray:
+        return positions[positions != GridService.MISSING].astype(np.int64) + 1
 
     def get(self) -> str:
         daily_data_full = self.data
@@ -133,109 +279,241 @@ class GridService:
                 value_to_use = row[self.coordinates_basis] if not pd.isna(row[self.coordinates_basis]) else None
                 if value_to_use is not None:
                     position = int((value_to_use - daily_low_depth) / grid_step_full)
-                    y_label = self._get_label(position)
+                    y_label = self._labels(position + 1)[position]
                     coord = f"{y_label}{i + 1}"
                     coordinates_str.append(coord)
 
         return '-'.join(coordinates_str)
 
+    def get_positions_by_days(self, days: Iterable[str] = None, skip_broken: bool = False) -> Dict[str, np.ndarray]:
+        """
+                Grids of every day of a multi-day frame (or of `days` only),
+                computed with grouped array operations instead of a GridService per day.
+                A day whose grid can't be built raises ValueError, or with `skip_broken` is logged and left out.
+
+                Each grid is a uint16 row of `depth` positions (MISSING where get() skips the slot),
+                a view into one days x depth matrix. to_string() of a row equals get() on data.loc[day].
+
+                Example -> key:2022-03-30, value: array([2, 3, 1, ...]) ~ 'C1-D2-B3-...'
+            """
+
+        day_keys = self.data.index.to_numpy().astype('datetime64[D]')
+        rows = np.argsort(day_keys, kind='stable')
+        if days is not None:
+            rows = rows[np.isin(day_keys[rows], np.array(list(days), dtype='datetime64[D]'))]
+        if len(rows) == 0:
+            return {}
+
+        dates, starts = np.unique(day_keys[rows], return_index=True)
+        ends = np.append(starts[1:], len(rows))
+
+        daily_high_full = np.fmax.reduceat(self.data['high'].to_numpy(dtype=np.float64)[rows], starts)
+        daily_low_full = np.fmin.reduceat(self.data['low'].to_numpy(dtype=np.float64)[rows], starts)
+
+        # days x depth window of the coordinates basis, NaN where a day has fewer bars than depth
+        slots = starts[:, None] + np.arange(self.depth)
+        in_day = slots < ends[:, None]
+        values = self.data[self.coordinates_basis].to_numpy(dtype=np.float64)[rows[np.where(in_day, slots, 0)]]
+        values[~in_day] = np.nan
+        valid = ~np.isnan(values)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            daily_low_depth = np.fmin.reduce(values, axis=1)
+            grid_height_full = np.ceil((daily_high_full - daily_low_full) / self.type_vol)
+            grid_step_full = (daily_high_full - daily_low_full) / grid_height_full
+            positions = np.trunc((values - daily_low_depth[:, None]) / grid_step_full[:, None])
+
+        broken = ~np.isfinite(grid_height_full) | (valid.any(axis=1) & ~np.isfinite(grid_step_full))
+        if broken.any() and skip_broken:
+            log(f"Skipped {int(broken.sum())} days whose grid can't be built: "
+                f"{', '.join(dates[broken].astype(str).tolist())}")
+            dates, positions, valid = dates[~broken], positions[~broken], valid[~broken]
+        elif broken.any():
+            raise ValueError(f"Grid of day {dates[np.argmax(broken)]} can't be built: "
+                             f"high={daily_high_full[np.argmax(broken)]}, low={daily_low_full[np.argmax(broken)]}")
+
+        positions = np.where(valid, positions, self.MISSING)
+        if positions[valid].max(initial=0) >= self.MISSING:
+            raise ValueError(f"Grid positions don't fit uint16, type_vol={self.type_vol} is too small")
+
+        return dict(zip(dates.astype(str).tolist(), positions.astype(np.uint16)))
+
+    def get_by_days(self, days: Iterable[str] = None, skip_broken: bool = False) -> Dict[str, str]:
+        return {date: self.to_string(positions)
+                for date, positions in self.get_positions_by_days(days, skip_broken).items()}
+
+
+# Labels of positions 0..701 (A..ZZ), see GridService._labels()
+_LABELS: List[str] = [GridService._get_label(i) for i in range(26 * 27)]
+
 
 class GroupByCorrelationService:
+    correlation_threshold = 0.85
 
     @staticmethod
-    def _convert_grid_to_numerical(coord_str):
-        return [ord(c[0]) - ord('A') + 1 for c in coord_str.split('-')]
+    def _convert_grid_to_numerical(grid):
+        if isinstance(grid, str):
+            return [GridService._parse_label(c.rstrip('0123456789')) + 1 for c in grid.split('-')]
+        return GridService.to_numerical(grid)
 
     @staticmethod
     def _find_correlated_pairs(data, threshold):
-        correlated_pairs = {}
-        for (index1, row1), (index2, row2) in combinations(data.iterrows(), 2):
-            if len(row1['num_coords']) == len(row2['num_coords']):
-                correlation = np.corrcoef(row1['num_coords'], row2['num_coords'])[0, 1]
-                if correlation > threshold:
-                    correlated_pairs[(index1, index2)] = correlation
-        return correlated_pairs
+        return CorrelationEngine().correlated_pairs(data['num_coords'].tolist(), threshold, data.index)
 
     @staticmethod
-    def _find_correlated_groups(pairs, threshold):
-        groups = []
+    def _find_correlated_groups(pairs, threshold, groups=None, new_pairs=None):
+        """
+                Greedy clique assembly over the correlation graph (days are vertices,
+                pairs with correlation >= threshold are edges), pair by pair in order:
+                a pair (i, j) joins the first group whose every member is adjacent to both i and j,
+                otherwise it starts the group {i, j}. Every group is a clique, a day can be in several
+                groups, and the result is deterministic for a given pairs order.
+                Existing `groups` are extended in place by `new_pairs` (all pairs by default).
+
+                Each group keeps its candidates (days adjacent to all its members) and each day the groups
+                it is a candidate of, so the first matching group of a pair is the minimum of an intersection
+                and adding to a group only removes candidates, instead of rechecking all members.
+            """
+        groups = [] if groups is None else groups
 
+        neighbours = {}
         for (idx1, idx2), corr in pairs.items():
-            added = False
-            for group in groups:
-                if all(pairs.get((min(idx1, idx), max(idx1, idx)), 0) >= threshold and
-                       pairs.get((min(idx2, idx), max(idx2, idx)), 0) >= threshold for idx in group):
-                    group.update({idx1, idx2})
-                    added = True
-                    break
-
-            if not added:
+            if corr >= threshold:
+                neighbours.setdefault(idx1, set()).add(idx2)
+                neighbours.setdefault(idx2, set()).add(idx1)
+
+        no_neighbours = set()
+        candidates = [set.intersection(*(neighbours.get(idx, no_neighbours) for idx in group)) for group in groups]
+        candidate_of = {}
+        for k, group_candidates in enumerate(candidates):
+            for idx in group_candidates:
+                candidate_of.setdefault(idx, set()).add(k)
+
+        for idx1, idx2 in (pairs.keys() if new_pairs is None else new_pairs):
+            common = neighbours.get(idx1, no_neighbours) & neighbours.get(idx2, no_neighbours)
+            matching = candidate_of.get(idx1, no_neighbours) & candidate_of.get(idx2, no_neighbours)
+            if matching:
+                k = min(matching)
+                groups[k].update({idx1, idx2})
+                dropped = candidates[k] - common
+                candidates[k] -= dropped
+                for idx in dropped:
+                    candidate_of[idx].discard(k)
+            else:
+                k = len(groups)
                 groups.append({idx1, idx2})
+                candidates.append(common)
+                for idx in common:
+                    candidate_of.setdefault(idx, set()).add(k)
 
         return groups
 
-    def group(self, test_results: dict) -> pd.DataFrame:
-        data = BarMapper.test_results_to_pandas_df(test_results)
-        data['num_coords'] = data['grid'].apply(self._convert_grid_to_numerical)
+    def correlate(self, grids: list) -> Tuple[Dict[Tuple[int, int], float], List[set]]:
+        """
+                Correlated pairs and groups of grids, keyed by position in `grids`.
+                They depend on the grids only, so they can be reused by group()
+                for other strategy results over the same days.
+            """
+        data = pd.DataFrame({'num_coords': [self._convert_grid_to_numerical(grid) for grid in grids]})
+        correlated_pairs = self._find_correlated_pairs(data, self.correlation_threshold)
+        return correlated_pairs, self._find_correlated_groups(correlated_pairs, self.correlation_threshold)
 
-        correlation_threshold = 0.85
-        correlated_pairs = self._find_correlated_pairs(data, correlation_threshold)
-        correlated_groups = self._find_correlated_groups(correlated_pairs, correlation_threshold)
+    def correlate_new(self, grids: list, new_from: int,
+                      correlated: Tuple[Dict[Tuple[int, int], float], List[set]]) \
+            -> Tuple[Dict[Tuple[int, int], float], List[set], List[set]]:
+        """
+                Incremental correlate(): grids from position `new_from` on are new, `correlated` holds
+                the pairs and groups of the ones before. Only pairs with a new grid are computed,
+                and existing groups are updated with them rather than rebuilt.
+                Returns all pairs, all groups and the groups that were created or extended.
+            """
+        correlated_pairs, correlated_groups = correlated
+        new_pairs = CorrelationEngine().correlated_pairs(
+            [self._convert_grid_to_numerical(grid) for grid in grids], self.correlation_threshold, new_from=new_from)
+        correlated_pairs = {**correlated_pairs, **new_pairs}
 
-        grouped_data = []
-        for group in correlated_groups:
-            group_data = data.loc[list(group)]
-            avg_correlation = np.mean(
-                [correlated_pairs[(min(idx1, idx2), max(idx1, idx2))] for idx1 in group for idx2 in group if
-                 idx1 != idx2])
-            for _, row in group_data.iterrows():
-                key = (tuple(group), row['date'])
-                if key not in grouped_data:
-                    grouped_data.append({
-                        'group': ' '.join(map(str, group)),
-                        'stock_name': row['stock'],
-                        'average_correlation': avg_correlation,
-                        'date': row['date'],
-                        'coordinates': row['grid'],
-                        'side': row['opened_side'],
-                        'result': row['revenue'],
-                        'open': row['opened_price'],
-                        'close': row['closed_price'],
-                        'close_status': row['close_type'],
-                        'open_time': row['opened_time'],
-                        'close_time': row['closed_time']
-                    })
+        sizes = [len(group) for group in correlated_groups]
+        correlated_groups = self._find_correlated_groups(
+            correlated_pairs, self.correlation_threshold, correlated_groups, new_pairs.keys())
+        touched_groups = [group for k, group in enumerate(correlated_groups) if k >= len(sizes) or len(group) != sizes[k]]
 
-        return pd.DataFrame(grouped_data)
+        return correlated_pairs, correlated_groups, touched_groups
 
+    def group(self, test_results: dict, correlated: Tuple[Dict[Tuple[int, int], float], List[set]] = None) \
+            -> pd.DataFrame:
+        data = BarMapper.test_results_to_pandas_df(test_results)
+        correlated_pairs, correlated_groups = correlated if correlated is not None \
+            else self.correlate(data['grid'].tolist())
 
-class GroupByCorrelationService2:
+        return self.group_rows(data, correlated_pairs, correlated_groups)
 
     @staticmethod
-    def _convert_grid_to_numerical(coord_str):
-        return [ord(c[0]) - ord('A') + 1 for c in coord_str.split('-')]
+    def group_rows(data: pd.DataFrame, correlated_pairs: Dict[Tuple[int, int], float], correlated_groups: List[set]) \
+            -> pd.DataFrame:
+        if not correlated_groups:
+            return pd.DataFrame()
+
+        members = [list(group) for group in correlated_groups]
+        rows = data.loc[[idx for group in members for idx in group]]
+        sizes = [len(group) for group in members]
+        avg_correlations = [np.mean([correlated_pairs[(min(idx1, idx2), max(idx1, idx2))]
+                                     for idx1 in group for idx2 in group if idx1 != idx2]) for group in members]
+
+        return pd.DataFrame({
+            'group': np.repeat([' '.join(map(str, group)) for group in members], sizes),
+            'stock_name': rows['stock'].to_numpy(),
+            'average_correlation': np.repeat(avg_correlations, sizes),
+            'date': rows['date'].to_numpy(),
+            'coordinates': [GridService.to_string(grid) for grid in rows['grid']],
+            'side': rows['opened_side'].to_numpy(),
+            'result': rows['revenue'].to_numpy(),
+            'open': rows['opened_price'].to_numpy(),
+            'close': rows['closed_price'].to_numpy(),
+            'close_status': rows['close_type'].to_numpy(),
+            'open_time': rows['opened_time'].to_numpy(),
+            'close_time': rows['closed_time'].to_numpy()
+        })
+
+
+class GroupByCorrelationService2:
+
+    def __init__(self, sparse: bool = False, block_size: int = 1024):
+        self.sparse = sparse
+        self.engine = CorrelationEngine(block_size=block_size)
 
     @staticmethod
-    def _find_correlation_matrix(data):
-        n = len(data)
-        correlation_matrix = np.ones((n, n))
-        for i, row1 in data.iterrows():
-            for j, row2 in data.iterrows():
-                if i < j:
-                    correlation = np.corrcoef(row1['num_coords'], row2['num_coords'])[0, 1]
-                    correlation_matrix[i, j] = correlation
-                    correlation_matrix[j, i] = correlation
-        return correlation_matrix
+    def _convert_grid_to_numerical(grid):
+        if isinstance(grid, str):
+            return [GridService._parse_label(c.rstrip('0123456789')) + 1 for c in grid.split('-')]
+        return GridService.to_numerical(grid)
+
+    def _find_correlation_matrix(self, data, threshold=None):
+        return self.engine.correlation_matrix(data['num_coords'].tolist(), threshold)
+
+    def _find_radius_graph(self, data, threshold):
+        return self.engine.radius_graph(data['num_coords'].tolist(), threshold)
 
     def group(self, test_results: dict) -> pd.DataFrame:
         data = BarMapper.test_results_to_pandas_df(test_results)
         data['num_coords'] = data['grid'].apply(self._convert_grid_to_numerical)
+        # A constant grid has no correlation with anything, it's noise in both paths
+        varying = data['num_coords'].apply(lambda coords: np.ptp(coords) > 0 if len(coords) else False)
+        data = data[varying].reset_index(drop=True)
+        if data.empty:
+            return pd.DataFrame()
 
-        correlation_threshold = 0.85
-        correlation_matrix = self._find_correlation_matrix(data)
+        from sklearn.cluster import DBSCAN
 
+        correlation_threshold = 0.85
         dbscan = DBSCAN(eps=1 - correlation_threshold, min_samples=2, metric='precomputed')
-        labels = dbscan.fit_predict(1 - correlation_matrix)
+
+        if self.sparse:
+            # Only neighbours within eps are kept, the full n x n matrix is never allocated
+            correlation_matrix = None
+            labels = dbscan.fit_predict(self._find_radius_graph(data, correlation_threshold))
+        else:
+            correlation_matrix = self._find_correlation_matrix(data, correlation_threshold)
+            labels = dbscan.fit_predict(1 - correlation_matrix)
 
         data['Group'] = labels
 
@@ -244,15 +522,18 @@ class GroupByCorrelationService2:
             if group == -1:
                 continue
             group_data = data[data['Group'] == group]
-            avg_correlation = np.mean(
-                [correlation_matrix[i, j] for i in group_data.index for j in group_data.index if i != j])
+            if correlation_matrix is None:
+                avg_correlation = self.engine.mean_correlation(group_data['num_coords'].tolist())
+            else:
+                group_matrix = correlation_matrix[np.ix_(group_data.index, group_data.index)]
+                avg_correlation = np.mean(group_matrix[~np.eye(len(group_data), dtype=bool)])
             for _, row in group_data.iterrows():
                 grouped_data.append({
                     'group': 'Group ' + str(group),
                     'stock_name': row['stock'],
                     'average_correlation': avg_correlation,
                     'date': row['date'],
-                    'coordinates': row['grid'],
+                    'coordinates': GridService.to_string(row['grid']),
                     'side': row['opened_side'],
                     'result': row['revenue'],
                     'open': row['opened_price'],
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from ent.base_ds import BaseConfig
+from ent.correlation import CorrelationEngine
+from ent.service import DataProviderService, GridService
+from ent.utils import generate_file_path, get_stock_name, log
+
+
+class SessionIndex:
+    """
+        Index of trading sessions by grid, for top-k most correlated sessions queries.
+
+        Grids are stored as z-normalized rows of one matrix per vector length (only equal-length
+        grids are compared, as in GroupByCorrelationService), so the correlation of a query with
+        every indexed session is one matrix-vector product. Search is exact: scores are taken in
+        row blocks of `block_size` and the best k are selected with argpartition.
+
+        A session is keyed by (stock_name, date); adding a key again replaces its grid.
+    """
+
+    def __init__(self, params: dict = None, block_size: int = 1 << 16):
+        self.params = params if params is not None else {}
+        self.block_size = block_size
+        # length -> (stock names, dates, z-normalized matrix)
+        self.buckets: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    def __len__(self):
+        return sum(len(dates) for _, dates, _ in self.buckets.values())
+
+    @staticmethod
+    def to_vector(grid) -> np.ndarray:
+        """
+            Numerical vector of a grid given as a positions row, a 'A1-B2-...' string or numbers.
+        """
+        if isinstance(grid, str):
+            return np.array([GridService._parse_label(c.rstrip('0123456789')) + 1 for c in grid.split('-')],
+                            dtype=np.float64)
+        grid = np.asarray(grid)
+        if grid.dtype == np.uint16:
+            return GridService.to_numerical(grid).astype(np.float64)
+        return grid.astype(np.float64)
+
+    def add(self, stock_name: str, grids: Dict[str, np.ndarray]) -> None:
+        """
+            Example -> add('ABC', {'2022-03-30': array([2, 3, 1, ...]), ...}) with grids of GridService.
+        """
+        self.add_all([(stock_name, grids)])
+
+    def add_all(self, sessions: Iterable[Tuple[str, Dict[str, np.ndarray]]]) -> None:
+        """
+            add() of the grids of several stocks, merged into every bucket at once.
+            Example -> add_all([('ABC', grids_of_abc), ('XYZ', grids_of_xyz)])
+        """
+        parts: Dict[int, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = {}
+        for stock_name, grids in sessions:
+            vectors = [self.to_vector(grid) for grid in grids.values()]
+            dates = np.array(list(grids.keys()), dtype='datetime64[D]')
+            for positions, matrix in CorrelationEngine.bucket_by_length(vectors).values():
+                parts.setdefault(matrix.shape[1], []).append((np.full(len(positions), stock_name, dtype=object),
+                                                              dates[positions],
+                                                              CorrelationEngine.z_normalize(matrix)))
+        for length, columns in parts.items():
+            stocks, dates, z = (np.concatenate(column) for column in zip(*columns))
+            self._append(length, stocks, dates, z)
+
+    def _append(self, length: int, stocks: np.ndarray, dates: np.ndarray, z: np.ndarray) -> None:
+        if length in self.buckets:
+            old_stocks, old_dates, old_z = self.buckets[length]
+            stocks = np.concatenate([old_stocks, stocks])
+            dates = np.concatenate([old_dates, dates])
+            z = np.concatenate([old_z, z])
+
+        # Last occurrence of a key wins
+        keys = np.char.add(stocks.astype(str), dates.astype(str))
+        _, last = np.unique(keys[::-1], return_index=True)
+        keep = np.sort(len(keys) - 1 - last)
+        self.buckets[length] = (stocks[keep], dates[keep], np.ascontiguousarray(z[keep]))
+
+    def get(self, stock_name: str, date: str) -> np.ndarray:
+        """
+            Z-normalized grid of an indexed session.
+        """
+        for stocks, dates, z in self.buckets.values():
+            found = np.flatnonzero((dates == np.datetime64(date, 'D')) & (stocks == stock_name))
+            if len(found):
+                return z[found[0]]
+        raise KeyError(f'Session {stock_name} {date} is not indexed')
+
+    def query(self, grid, k: int = 10, stock_names: Iterable[str] = None) -> List[Tuple[str, str, float]]:
+        """
+            k sessions whose grids correlate most with `grid`, optionally only of `stock_names`.
+            For an intraday query pass the grid of the bars printed so far, once there are `depth` of them.
+            Example -> [('ABC', '2021-11-04', 0.97), ('XYZ', '2022-01-12', 0.95), ...]
+        """
+        return self._query(CorrelationEngine.z_normalize(self.to_vector(grid)[None, :])[0], k, stock_names)
+
+    def query_date(self, stock_name: str, date: str, k: int = 10,
+                   stock_names: Iterable[str] = None) -> List[Tuple[str, str, float]]:
+        """
+            k sessions most correlated with an indexed session, the session itself excluded.
+        """
+        results = self._query(self.get(stock_name, date), k + 1, stock_names)
+        return [r for r in results if (r[0], r[1]) != (stock_name, date)][:k]
+
+    def _query(self, z: np.ndarray, k: int, stock_names: Iterable[str] = None) -> List[Tuple[str, str, float]]:
+        if len(z) not in self.buckets or not np.isfinite(z).all():
+            return []
+
+        stocks, dates, matrix = self.buckets[len(z)]
+        allowed = np.isin(stocks, list(stock_names)) if stock_names is not None else None
+
+        best_rows, best_scores = np.empty(0, dtype=np.int64), np.empty(0)
+        for start in range(0, len(matrix), self.block_size):
+            scores = matrix[start:start + self.block_size] @ z
+            scores[~np.isfinite(scores)] = -np.inf
+            if allowed is not None:
+                scores[~allowed[start:start + self.block_size]] = -np.inf
+
+            rows = np.concatenate([best_rows, np.arange(start, start + len(scores))])
+            scores = np.concatenate([best_scores, scores])
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                rows, scores = rows[top], scores[top]
+            best_rows, best_scores = rows, scores
+
+        order = np.argsort(-best_scores, kind='stable')
+        return [(stocks[row], str(dates[row]), float(min(score, 1.0)))
+                for row, score in zip(best_rows[order].tolist(), best_scores[order].tolist()) if score > -np.inf]
+
+    def save(self, path: str) -> None:
+        arrays = {}
+        for length, (stocks, dates, z) in self.buckets.items():
+            arrays[f'stocks_{length}'] = stocks.astype(str)
+            arrays[f'dates_{length}'] = dates
+            arrays[f'z_{length}'] = z
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.tmp-{os.getpid()}.npz'
+        np.savez(tmp_path, params=json.dumps(self.params), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'SessionIndex':
+        with np.load(path) as data:
+            index = cls(json.loads(str(data['params'])))
+            for name in data.files:
+                if name.startswith('z_'):
+                    length = int(name[2:])
+                    index.buckets[length] = (data[f'stocks_{length}'].astype(object), data[f'dates_{length}'],
+                                             data[name])
+        return index
+
+    @staticmethod
+    def grid_params(config: BaseConfig) -> dict:
+        return {
+            'type_vol': config.type_vol,
+            'depth': config.depth,
+            'coordinates_basis': config.coordinates_basis,
+            'sma_window': config.sma_window if config.coordinates_basis == 'sma' else None,
+        }
+
+    @staticmethod
+    def default_path(config: BaseConfig) -> str:
+        params = SessionIndex.grid_params(config)
+        name = '-'.join(str(params[key]) for key in ('type_vol', 'depth', 'coordinates_basis', 'sma_window'))
+        return os.path.join(generate_file_path('index'), f'sessions-{name}.npz')
+
+    @classmethod
+    def build(cls, configs: List[BaseConfig]) -> 'SessionIndex':
+        """
+            Index of every trading day of the configs' files, which must share grid parameters.
+            Days the jobs don't backtest (incomplete sessions) aren't indexed, and days whose grid
+            can't be built are logged and skipped.
+        """
+        index = cls(cls.grid_params(configs[0]))
+
+        def sessions():
+            for config in configs:
+                if cls.grid_params(config) != index.params:
+                    raise ValueError(f'Grid parameters of {config.file_path} differ from {index.params}')
+
+                data = DataProviderService(config).read_5min_data()
+                grids = GridService(config.type_vol, config.depth, config.coordinates_basis, data.get_pandas_df()) \
+                    .get_positions_by_days(data.get_data_as_trading_days().keys(), skip_broken=True)
+                yield get_stock_name(config.file_path), grids
+
+        # Buckets are concatenated and deduplicated once, not once per stock
+        index.add_all(sessions())
+        return index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query the index of sessions by grid')
+    parser.add_argument('--sma-window', type=int, default=3)
+    parser.add_argument('--type-vol', type=float, default=0.25)
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument('--coordinates-basis', default='close')
+    parser.add_argument('--index', default=None, help='index file (default: index/sessions-<grid parameters>.npz)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('build', help='index every file in source_data')
+    query_parser = commands.add_parser('query', help='sessions most correlated with a session')
+    query_parser.add_argument('stock_name')
+    query_parser.add_argument('date')
+    query_parser.add_argument('-k', type=int, default=10)
+    query_parser.add_argument('--stocks', nargs='*', default=None, help='search these stocks only')
+    args = parser.parse_args()
+
+    sd_folder_path = generate_file_path('source_data')
+    configs = [BaseConfig().builder()
+               .with_file_path(os.path.join(sd_folder_path, f))
+               .with_sma_window(args.sma_window)
+               .with_type_vol(args.type_vol)
+               .with_depth(args.depth)
+               .with_coordinates_basis(args.coordinates_basis)
+               .build() for f in sorted(os.listdir(sd_folder_path))]
+    path = args.index if args.index else SessionIndex.default_path(configs[0])
+
+    if args.command == 'build':
+        session_index = SessionIndex.build(configs)
+        session_index.save(path)
+        log(f'Indexed {len(session_index)} sessions to {path}')
+    else:
+        for stock_name, date, correlation in SessionIndex.load(path).query_date(
+                args.stock_name, args.date, args.k, args.stocks):
+            log(f'{stock_name} {date} {correlation:.4f}')
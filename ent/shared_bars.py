@@ -0,0 +1,216 @@
+import mmap
+import os
+import secrets
+from multiprocessing import resource_tracker
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from ent.base_ds import BaseConfig, BarStore
+from ent.utils import log
+
+
+class SharedBars:
+    """
+        Picklable handle of a BarStore whose columns lie back to back in one shared memory segment.
+        Processes attach zero-copy views by segment name, so any number of jobs on a ticker share
+        one parsed copy of its bars.
+
+        Segments are meant for descendants of the process that owns them (pool workers), which share
+        its resource tracker: attaching doesn't change ownership, and the tracker still unlinks
+        the segments if the owner dies without releasing them.
+        Example -> handle = SharedBars.create(store, 'ABC'); ... handle.attach() in a worker
+    """
+
+    dtypes = {'date_time': np.dtype('datetime64[ns]'), 'price_open': np.dtype(np.float64),
+              'price_high': np.dtype(np.float64), 'price_low': np.dtype(np.float64),
+              'price_close': np.dtype(np.float64), 'volume': np.dtype(np.int64), 'ts': np.dtype(np.float64)}
+
+    def __init__(self, name: str, length: int, key: str, start: int = 0, end: int = None, capacity: int = None):
+        self.name = name
+        self.length = length
+        self.key = key
+        # Rows attach() maps, e.g. the days of one chunk of a ticker
+        self.start = start
+        self.end = end if end is not None else length
+        # Rows every column has room for, more than length when the bars were streamed in
+        self.capacity = capacity if capacity is not None else length
+        # Day index of all rows, as BarStore.days(), set on the handles of a whole segment
+        self.days: Tuple[List[str], np.ndarray] = None
+
+    def __str__(self):
+        return f"SharedBars(key={self.key}, name={self.name}, length={self.length}, rows={self.start}:{self.end})"
+
+    @property
+    def whole(self) -> bool:
+        return self.start == 0 and self.end == self.length
+
+    def rows(self, start: int, end: int) -> 'SharedBars':
+        """
+            Handle of rows [start, end) of the segment: attach() maps only their pages,
+            so the address space of a worker holding it doesn't grow with the whole file.
+        """
+        return SharedBars(self.name, self.length, self.key, start, end, self.capacity)
+
+    def chunks(self, chunk_rows: int) -> Iterator[BarStore]:
+        """
+            Stores of consecutive whole days of about `chunk_rows` bars, each mapping only its own rows.
+        """
+        _, offsets = self.days if self.days is not None else self.attach().days()
+        start = 0
+        for end in offsets[1:].tolist():
+            if end - start >= chunk_rows or end == self.length:
+                yield self.rows(start, end).attach()
+                start = end
+
+    @classmethod
+    def create(cls, store: BarStore, key: str) -> 'SharedBars':
+        """
+            Copies the columns of `store` to a new segment, owned by the caller until it's unlink()-ed.
+        """
+        return cls.create_streamed([store], len(store), key)
+
+    @classmethod
+    def create_streamed(cls, stores: Iterable[BarStore], capacity: int, key: str) -> 'SharedBars':
+        """
+            New segment of bars coming in stores of whole days, at most `capacity` of them, e.g. from
+            DataProviderService.stream_5min_data(): every store is written through a mapping of its own rows,
+            so neither the bars nor the segment are ever mapped whole by the caller.
+            Pages of the rows left unused aren't allocated.
+        """
+        import _posixshmem
+
+        name = f'ent_{secrets.token_hex(8)}'
+        fd = _posixshmem.shm_open('/' + name, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        try:
+            os.ftruncate(fd, max(sum(capacity * dtype.itemsize for dtype in cls.dtypes.values()), 1))
+        finally:
+            os.close(fd)
+        # Tracked as SharedMemory(create=True) would be, so unlink() and a dead owner clean it up alike
+        resource_tracker.register('/' + name, 'shared_memory')
+        handle = cls(name, 0, key, capacity=capacity)
+
+        try:
+            dates, offsets = [], [0]
+            for store in stores:
+                if handle.length + len(store) > capacity:
+                    raise ValueError(f'{key} has more than the {capacity} bars expected')
+                for column, view in handle._map_rows(handle.length, handle.length + len(store), True).items():
+                    view[:] = getattr(store, column)
+                store_dates, store_offsets = store.days()
+                dates.extend(store_dates)
+                offsets.extend((store_offsets[1:] + handle.length).tolist())
+                handle.length += len(store)
+        except BaseException:
+            handle.unlink()
+            raise
+
+        handle.end = handle.length
+        handle.days = (dates, np.array(offsets, dtype=np.int64))
+        return handle
+
+    def _map_rows(self, start: int, end: int, writable: bool = False) -> Dict[str, np.ndarray]:
+        # Mappings of the pages of rows [start, end) of every column, unmapped with their views
+        import _posixshmem
+
+        fd = _posixshmem.shm_open('/' + self.name, os.O_RDWR if writable else os.O_RDONLY, 0o600)
+        try:
+            views = {}
+            offset = 0
+            for name in BarStore.columns():
+                dtype = self.dtypes[name]
+                first, size = offset + start * dtype.itemsize, (end - start) * dtype.itemsize
+                page = first - first % mmap.ALLOCATIONGRANULARITY
+                access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+                views[name] = np.frombuffer(mmap.mmap(fd, first - page + size, access=access, offset=page),
+                                            dtype, end - start, first - page) if size else np.empty(0, dtype)
+                offset += self.capacity * dtype.itemsize
+            return views
+        finally:
+            os.close(fd)
+
+    def attach(self, preceding: int = 0) -> BarStore:
+        """
+            Read-only BarStore of views on the handle's rows, and up to `preceding` rows before them.
+            Only their pages are mapped, and unmapped once the views are gone.
+        """
+        views = self._map_rows(max(self.start - preceding, 0), self.end)
+        return BarStore(*[views[name] for name in BarStore.columns()])
+
+    def unlink(self) -> None:
+        # By name, as SharedMemory.unlink() does, without mapping the segment
+        import _posixshmem
+
+        _posixshmem.shm_unlink('/' + self.name)
+        resource_tracker.unregister('/' + self.name, 'shared_memory')
+
+
+def load_shared_bars(config: BaseConfig, chunk_rows: int = None) -> SharedBars:
+    """
+        Parses (or loads from the cache) the bars of a config's file into a new segment, in a pool worker;
+        the parent adopts it with SharedBarRegistry.adopt(). With `chunk_rows` (config.read_chunk_rows
+        by default) they're streamed in chunks of about that many bars, so the worker holds one chunk
+        at a time. Files not sorted by date can't be streamed and are read whole.
+    """
+    from ent.service import DataProviderService
+
+    provider = DataProviderService(config)
+    chunk_rows = chunk_rows if chunk_rows else config.read_chunk_rows
+    if chunk_rows:
+        try:
+            return SharedBars.create_streamed((chunk.bar_store for chunk in provider.stream_5min_data(chunk_rows)),
+                                              provider.max_5min_bars(), config.file_path)
+        except ValueError as e:
+            log(f'Bars of {config.file_path} are read whole: {e}')
+    return SharedBars.create(provider.read_5min_data().bar_store, config.file_path)
+
+
+class SharedBarRegistry:
+    """
+        Reference counts of the shared bars of a run, in the process owning them.
+        A segment is unlinked when its last reference is released, or by close().
+        Create it before the worker pool: pool workers inherit the resource tracker started here,
+        otherwise each starts its own, which unlinks the segments it saw when the worker exits.
+        Example -> with SharedBarRegistry() as registry: shared = registry.adopt(handle); ...
+    """
+
+    def __init__(self):
+        self.handles: Dict[str, SharedBars] = {}
+        self.refs: Dict[str, int] = {}
+        resource_tracker.ensure_running()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self.handles)
+
+    def adopt(self, handle: SharedBars, refs: int = 1) -> SharedBars:
+        """
+            Takes ownership of a segment created by another process. A second segment of the same file
+            is unlinked in favour of the registered one.
+        """
+        registered = self.handles.get(handle.key)
+        if registered is not None and registered.name != handle.name:
+            handle.unlink()
+            handle = registered
+        self.handles[handle.key] = handle
+        self.refs[handle.key] = self.refs.get(handle.key, 0) + refs
+        return handle
+
+    def release(self, handle: SharedBars, refs: int = 1) -> None:
+        if handle.key not in self.refs:
+            return
+        self.refs[handle.key] -= refs
+        if self.refs[handle.key] <= 0:
+            del self.refs[handle.key]
+            self.handles.pop(handle.key).unlink()
+
+    def close(self) -> None:
+        for key in list(self.handles):
+            self.refs.pop(key, None)
+            self.handles.pop(key).unlink()
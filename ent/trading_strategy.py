@@ -1,4 +1,6 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+
+import numpy as np
 
 from ent.base_ds import TradingDay, TestResults
 
@@ -48,6 +50,59 @@ class Strategy:
                                        self.side, day.stock_name, self.opened_price, self.opened_time,
                                        self.closed_price, self.closed_time)
 
+    def get_results_batch(self, days: List[TradingDay]) -> List[Optional[TestResults]]:
+        """
+            Vectorized get_results over many days: days of equal length are stacked into
+            (days x bars) OHLC matrices and every day is backtested at once.
+            Returns the same TestResults as get_results would, in the order of `days`.
+        """
+        results = [None] * len(days)
+        days_by_length = {}
+        for k, day in enumerate(days):
+            days_by_length.setdefault(len(day), []).append(k)
+
+        for length, positions in days_by_length.items():
+            stores = [days[k].store for k in positions]
+            batch = self._backtest(np.stack([store.price_open for store in stores]),
+                                   np.stack([store.price_high for store in stores]),
+                                   np.stack([store.price_low for store in stores]),
+                                   np.stack([store.price_close for store in stores]))
+            if batch is None:
+                continue
+
+            opened_price, is_long, is_stop_loss, closed_price, closed_bar = batch
+            for k, store, o, long, stop_loss, c, closed_at in zip(positions, stores, opened_price.tolist(),
+                                                                   is_long.tolist(), is_stop_loss.tolist(),
+                                                                   closed_price.tolist(), closed_bar.tolist()):
+                revenue = f'-{self.sl}' if stop_loss else f'{round(abs(((c - o) / o) * 100), 2)}'
+                results[k] = TestResults('stop_loss' if stop_loss else 'end_of_day', revenue,
+                                         "LONG" if long else "SHORT", days[k].stock_name,
+                                         o, store.date_time[self.depth].astype('datetime64[us]').item(),
+                                         c, store.date_time[closed_at].astype('datetime64[us]').item())
+        return results
+
+    def _backtest(self, price_open: np.ndarray, price_high: np.ndarray, price_low: np.ndarray,
+                  price_close: np.ndarray):
+        bars_count = price_open.shape[1]
+        if self.depth >= bars_count - 1:
+            return None
+
+        # Position is opened at the open of bar `depth`, stops are checked from the next bar on
+        opened_price = price_open[:, self.depth]
+        is_long = price_open[:, 0] <= price_close[:, self.depth]
+        long_stop_loss_price = opened_price * (1 - self.sl / 100)
+        short_stop_loss_price = opened_price * (1 + self.sl / 100)
+
+        hits = np.where(is_long[:, None],
+                        price_low[:, self.depth + 1:] < long_stop_loss_price[:, None],
+                        price_high[:, self.depth + 1:] > short_stop_loss_price[:, None])
+        is_stop_loss = hits.any(axis=1)
+        closed_bar = np.where(is_stop_loss, hits.argmax(axis=1) + self.depth + 1, bars_count - 1)
+        closed_price = np.where(is_stop_loss,
+                                np.where(is_long, long_stop_loss_price, short_stop_loss_price),
+                                price_close[:, -1])
+        return opened_price, is_long, is_stop_loss, closed_price, closed_bar
+
     def reset(self):
         self.opened_price = 0.0
         self.side = ""
@@ -1,4 +1,5 @@
 from datetime import datetime
+import math
 import os
 import re
 
@@ -26,6 +27,17 @@ def to_int(value: str) -> int:
         return int(value)
 
 
+def to_range(value: str, cast=float) -> list:
+    """
+        '0.25' -> [0.25], '0.25:1:0.25' -> [0.25, 0.5, 0.75, 1.0] (stop included, never exceeded)
+    """
+    if ':' not in value:
+        return [cast(value)]
+    start, stop, step = (float(part) for part in value.split(':'))
+    count = int(math.floor((stop - start) / step + 1e-9)) + 1
+    return [cast(round(start + i * step, 10)) for i in range(count)]
+
+
 def log(msg):
     print(msg)
 
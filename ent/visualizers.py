@@ -1,17 +1,25 @@
-from typing import List
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 
-import seaborn as sns
-import matplotlib.pyplot as plt
-import cufflinks as cf
-import plotly.offline as py
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
 import plotly.io as pio
+from plotly.subplots import make_subplots
 
 from ent.base_mapper import BarMapper
 from ent.base_ds import Bar, TradingDay
-from lightweight_charts import Chart
+
+# matplotlib, seaborn, cufflinks and lightweight_charts are imported by the functions using them,
+# render workers of export_charts only load plotly
 
 
 def qf_visualize(day: TradingDay, save=False):
+    import cufflinks as cf
+    import plotly.offline as py
+
     df = BarMapper().bars_list_to_pandas_df(day.bars)
 
     qf = cf.QuantFig(df, title=f"{day.stock_name} {day.date}", legend='top', name='GS')
@@ -27,6 +35,9 @@ def qf_visualize(day: TradingDay, save=False):
 
 
 def visualize_as_line_chart(bars: List[Bar]):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     plt.figure(figsize=(14, 5))
     sns.set_style("whitegrid")
 
@@ -44,6 +55,8 @@ def visualize_as_line_chart(bars: List[Bar]):
 
 
 def tw_visualize(day: TradingDay):
+    from lightweight_charts import Chart
+
     chart = Chart(toolbox=True)
     chart.legend(visible=True, font_size=14, font_family='Arial')
     chart.topbar.textbox('symbol', day.stock_name)
@@ -52,3 +65,98 @@ def tw_visualize(day: TradingDay):
     if not df.empty:
         chart.set(df)
     chart.show(block=True)
+
+
+class ChartTemplate:
+    """
+        Chart of qf_visualize (candles, SMA 10 / 20 of close, volume) built once as a plotly figure;
+        fill() only swaps trace data and the title, so a batch of days reuses one figure.
+    """
+
+    sma_windows = (10, 20)
+    sma_colors = ('green', 'lightgreen')
+    up_color = '#17BECF'
+    down_color = '#7F7F7F'
+
+    def __init__(self, width: int = 1200, height: int = 800):
+        self.width = width
+        self.height = height
+
+        figure = make_subplots(rows=2, cols=1, shared_xaxes=True, row_heights=[0.8, 0.2], vertical_spacing=0.03)
+        figure.add_trace(go.Candlestick(name='GS'), row=1, col=1)
+        for window, color in zip(self.sma_windows, self.sma_colors):
+            figure.add_trace(go.Scatter(name=f'SMA({window})', mode='lines', line=dict(color=color, width=2),
+                                        legendgroup='sma'), row=1, col=1)
+        figure.add_trace(go.Bar(name='volume', showlegend=False), row=2, col=1)
+        figure.update_layout(width=width, height=height, xaxis_rangeslider_visible=False,
+                             legend=dict(orientation='h', x=0, y=1.02, yanchor='bottom'))
+        self.figure = figure
+
+    @staticmethod
+    def day_columns(day: TradingDay) -> Dict[str, np.ndarray]:
+        """
+            Bar columns of a day, the only per-day payload sent to render workers.
+        """
+        store = day.store
+        return {'date_time': store.date_time, 'open': store.price_open, 'high': store.price_high,
+                'low': store.price_low, 'close': store.price_close, 'volume': store.volume}
+
+    def fill(self, title: str, columns: Dict[str, np.ndarray]) -> go.Figure:
+        x = columns['date_time']
+        close = pd.Series(columns['close'])
+        candles, *smas, volume = self.figure.data
+        with self.figure.batch_update():
+            candles.update(x=x, open=columns['open'], high=columns['high'], low=columns['low'], close=columns['close'])
+            for trace, window in zip(smas, self.sma_windows):
+                trace.update(x=x, y=close.rolling(window).mean().to_numpy())
+            volume.update(x=x, y=columns['volume'], marker_color=np.where(
+                columns['close'] >= columns['open'], self.up_color, self.down_color))
+            self.figure.layout.title.text = title
+        return self.figure
+
+
+# Template of a render worker, created by its first batch
+_template: ChartTemplate = None
+
+
+def _render_batch(jobs: List[Tuple[str, str, Dict[str, np.ndarray]]], width: int, height: int,
+                  image_format: str) -> List[str]:
+    global _template
+    if _template is None or (_template.width, _template.height) != (width, height):
+        _template = ChartTemplate(width, height)
+
+    for path, title, columns in jobs:
+        pio.write_image(_template.fill(title, columns), path, format=image_format, width=width, height=height)
+    return [path for path, _, _ in jobs]
+
+
+def export_charts(groups: Dict[str, List[TradingDay]],
+                  output_dir: str,
+                  max_workers: int = None,
+                  image_format: str = 'png',
+                  width: int = 1200,
+                  height: int = 800) -> List[str]:
+    """
+        Renders the days of every group to <output_dir>/<group>/<stock>-<date>.<image_format>.
+        Days are split into one batch per worker process, and each worker fills one ChartTemplate
+        for all of its days. Returns the written paths.
+        Example -> export_charts({'Group 1': [day1, day2], 'Group 2': [day3]}, 'charts')
+    """
+    jobs = []
+    for group, days in groups.items():
+        group_dir = os.path.join(output_dir, re.sub(r'[^\w.-]+', '_', str(group)).strip('_') or 'group')
+        os.makedirs(group_dir, exist_ok=True)
+        for day in days:
+            jobs.append((os.path.join(group_dir, f'{day.stock_name}-{day.date}.{image_format}'),
+                         f'{day.stock_name} {day.date}', ChartTemplate.day_columns(day)))
+    if not jobs:
+        return []
+
+    max_workers = min(max_workers if max_workers else os.cpu_count(), len(jobs))
+    if max_workers == 1:
+        return _render_batch(jobs, width, height, image_format)
+
+    batches = [jobs[k::max_workers] for k in range(max_workers)]
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(_render_batch, batch, width, height, image_format) for batch in batches]
+        return [path for future in futures for path in future.result()]